@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Load Test / Latency Benchmark for the Visual Search Server
+Runs fully offline against a locally started visual_search_server.py.
+
+- Generates a synthetic image corpus (mixed sizes, JPEG/PNG/WebP) once, seeded
+- Drives the selected endpoints at a configurable concurrency (closed loop)
+- Reports throughput, p50/p95/p99 latency and server/client memory over time
+- Saves results as JSON; --compare prints the deltas against a previous run
+
+Usage:
+  python benchmark_visual_search.py --start-server --concurrency 8 --requests 200
+  python benchmark_visual_search.py --url http://localhost:5001 --server-pid 1234 \\
+      --endpoints extract-json,extract-binary,search-hit --compare bench-results/previous.json
+
+Endpoints:
+  extract-json    POST /extract, base64 JSON in, JSON float list out
+  extract-binary  POST /extract, raw bytes in, float32 out
+  duplicates      POST /duplicates, raw bytes (hash lookup only)
+  search-hit      POST /search with indexed images, raw bytes (hash-duplicate path)
+  search-miss     POST /search with held-out images, raw bytes (CNN + embedding path)
+  hybrid          POST /hybrid by productId
+
+The search and hybrid endpoints index the corpus first, except for the held-out
+fifth of it that search-miss queries with.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from image_hash import phash, hash_to_hex
+
+ENDPOINTS = ['extract-json', 'extract-binary', 'duplicates', 'search-hit', 'search-miss', 'hybrid']
+# Endpoints that only make sense once seed_index() has indexed products
+INDEX_ENDPOINTS = {'search-hit', 'search-miss', 'hybrid'}
+# Share of the corpus kept out of the index so search-miss queries match no hash
+HELD_OUT_FRACTION = 0.2
+IMAGE_SIZES = [(96, 96), (320, 240), (640, 480), (1024, 768), (2048, 1536)]
+IMAGE_FORMATS = [('JPEG', 'jpg', 'image/jpeg'), ('PNG', 'png', 'image/png'), ('WEBP', 'webp', 'image/webp')]
+
+
+def generate_corpus(corpus_dir, n_images, seed=42):
+    """Create n_images synthetic product-like images (gradients, shapes, noise)."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    existing = sorted(f for f in os.listdir(corpus_dir) if not f.startswith('.'))
+    if len(existing) >= n_images:
+        return [os.path.join(corpus_dir, f) for f in existing[:n_images]]
+
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_images):
+        width, height = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+        pil_format, extension, _ = IMAGE_FORMATS[i % len(IMAGE_FORMATS)]
+
+        # Smooth colour gradient + a solid block + noise, so hashes and embeddings differ
+        y, x = np.mgrid[0:height, 0:width]
+        base = rng.integers(0, 256, size=3)
+        pixels = np.stack([
+            (base[c] + x * rng.uniform(-0.3, 0.3) + y * rng.uniform(-0.3, 0.3)) % 256
+            for c in range(3)
+        ], axis=-1)
+        x0, y0 = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        pixels[y0:y0 + height // 3, x0:x0 + width // 3] = rng.integers(0, 256, size=3)
+        pixels += rng.normal(0, 8, size=pixels.shape)
+
+        path = os.path.join(corpus_dir, f'image_{i:05d}.{extension}')
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, pil_format)
+        paths.append(path)
+    return paths
+
+
+def content_type_for(path):
+    extension = path.rsplit('.', 1)[-1].lower()
+    for _, ext, mimetype in IMAGE_FORMATS:
+        if ext == extension:
+            return mimetype
+    return 'application/octet-stream'
+
+
+def http_post(url, body, content_type, accept='application/json', timeout=120):
+    """POST and return (status, response bytes)."""
+    req = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': content_type,
+        'Accept': accept
+    })
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def wait_for_server(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'{url}/health', timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except Exception:
+            pass
+        time.sleep(1)
+    return False
+
+
+def start_server(port):
+    """Launch visual_search_server.py locally and return the process."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'visual_search_server.py')
+    env = dict(os.environ, VISUAL_SEARCH_PORT=str(port))
+    return subprocess.Popen([sys.executable, script], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def rss_mb(pid):
+    """Resident memory of a process in MB (Linux /proc), None if unavailable."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, server_pid, interval):
+        """Samples server and client RSS in the background while the load runs."""
+        super().__init__(daemon=True)
+        self.server_pid = server_pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+        self._t0 = time.time()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.samples.append({
+                't': round(time.time() - self._t0, 2),
+                'serverRssMb': rss_mb(self.server_pid) if self.server_pid else None,
+                'clientRssMb': rss_mb(os.getpid())
+            })
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def build_requests(endpoint, url, images, product_ids, held_out=()):
+    """
+    Return a function i -> (url, body, content_type, accept) for an endpoint
+
+    Args:
+        images: Query images as (path, bytes); the indexed ones for search-hit
+        product_ids: Product ids seed_index() gave the indexed images
+        held_out: Corpus images that were not indexed (search-miss queries)
+    """
+    def image(i):
+        path, data = images[i % len(images)]
+        return path, data
+
+    if endpoint == 'extract-json':
+        def make(i):
+            path, data = image(i)
+            body = json.dumps({'image': f'data:{content_type_for(path)};base64,' + base64.b64encode(data).decode()})
+            return f'{url}/extract', body.encode(), 'application/json', 'application/json'
+    elif endpoint == 'extract-binary':
+        def make(i):
+            path, data = image(i)
+            return f'{url}/extract', data, content_type_for(path), 'application/octet-stream'
+    elif endpoint == 'duplicates':
+        def make(i):
+            path, data = image(i)
+            return f'{url}/duplicates', data, content_type_for(path), 'application/json'
+    elif endpoint == 'search-hit':
+        def make(i):
+            path, data = image(i)
+            return f'{url}/search?topN=10', data, content_type_for(path), 'application/json'
+    elif endpoint == 'search-miss':
+        def make(i):
+            path, data = held_out[i % len(held_out)]
+            return f'{url}/search?topN=10', data, content_type_for(path), 'application/json'
+    elif endpoint == 'hybrid':
+        def make(i):
+            body = json.dumps({'productId': product_ids[i % len(product_ids)], 'userId': 'bench-user', 'topN': 10})
+            return f'{url}/hybrid', body.encode(), 'application/json', 'application/json'
+    else:
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+    return make
+
+
+def seed_index(url, images):
+    """Index the corpus through /extract + /index/products so search endpoints have data."""
+    product_ids = []
+    items = []
+    for i, (path, data) in enumerate(images):
+        status, body = http_post(f'{url}/extract', data, content_type_for(path), 'application/octet-stream')
+        if status != 200:
+            continue
+        product_id = f'bench_{i:05d}'
+        items.append({
+            'productId': product_id,
+            'embedding': np.frombuffer(body, dtype='<f4').tolist(),
+            'category': f'category_{i % 5}',
+            'price': float(10 + i),
+            'inStock': i % 4 != 0,
+            'hash': hash_to_hex(phash(Image.open(path)))
+        })
+        product_ids.append(product_id)
+    http_post(f'{url}/index/products', json.dumps({'items': items}).encode(), 'application/json')
+    return product_ids
+
+
+def run_endpoint(make_request, n_requests, concurrency, warmup):
+    """Closed-loop load: `concurrency` workers issue n_requests in total."""
+    for i in range(warmup):
+        try:
+            http_post(*make_request(i))
+        except Exception:
+            pass
+
+    latencies = np.zeros(n_requests)
+    errors = 0
+    sources = {}    # /search 'source' (hash / embeddings) -> count
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        request_url, body, content_type, accept = make_request(i)
+        started = time.perf_counter()
+        try:
+            status, response = http_post(request_url, body, content_type, accept)
+            failed = status != 200
+        except Exception:
+            failed = True
+        latencies[i] = time.perf_counter() - started
+        if failed:
+            with lock:
+                errors += 1
+        elif accept == 'application/json':
+            try:
+                source = json.loads(response).get('source')
+            except ValueError:
+                source = None
+            if source:
+                with lock:
+                    sources[source] = sources.get(source, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(n_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = latencies * 1000
+    stats = {
+        'requests': n_requests,
+        'errors': errors,
+        'elapsedSeconds': round(elapsed, 3),
+        'throughputRps': round(n_requests / elapsed, 2) if elapsed > 0 else None,
+        'latencyMs': {
+            'mean': round(float(latencies_ms.mean()), 2),
+            'p50': round(float(np.percentile(latencies_ms, 50)), 2),
+            'p95': round(float(np.percentile(latencies_ms, 95)), 2),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 2),
+            'max': round(float(latencies_ms.max()), 2)
+        }
+    }
+    if sources:
+        stats['sources'] = sources
+    return stats
+
+
+def compare(results, previous_path):
+    """Print throughput and latency deltas against a previous results file."""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\n Compared with {previous_path} ({previous.get('timestamp')}):")
+    for endpoint, current in results['endpoints'].items():
+        before = previous.get('endpoints', {}).get(endpoint)
+        if not before or 'skipped' in before or 'skipped' in current:
+            continue
+        for key, now, then in [
+            ('throughput', current['throughputRps'], before['throughputRps']),
+            ('p50', current['latencyMs']['p50'], before['latencyMs']['p50']),
+            ('p95', current['latencyMs']['p95'], before['latencyMs']['p95']),
+            ('p99', current['latencyMs']['p99'], before['latencyMs']['p99']),
+        ]:
+            if now and then:
+                print(f"   {endpoint:15s} {key:10s} {then:10.2f} -> {now:10.2f} ({(now - then) / then * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Visual search server load test')
+    parser.add_argument('--url', default=None, help='Server URL (default http://localhost:PORT)')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('VISUAL_SEARCH_PORT', 5001)))
+    parser.add_argument('--start-server', action='store_true', help='Launch visual_search_server.py locally')
+    parser.add_argument('--server-pid', type=int, default=None, help='PID of an already running server (for RSS)')
+    parser.add_argument('--endpoints', default='extract-json,extract-binary,duplicates,search-hit,search-miss',
+                        help=f"Comma-separated subset of: {', '.join(ENDPOINTS)}")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help='Requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per endpoint')
+    parser.add_argument('--images', type=int, default=50, help='Synthetic corpus size')
+    parser.add_argument('--corpus-dir', default=os.path.join('bench-results', 'corpus'))
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='Memory sampling period (s)')
+    parser.add_argument('--output', default=None, help='Results JSON path')
+    parser.add_argument('--compare', default=None, help='Previous results JSON to diff against')
+    args = parser.parse_args()
+
+    url = args.url or f'http://localhost:{args.port}'
+    endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error(f"Unknown endpoint: {endpoint}")
+
+    server = None
+    server_pid = args.server_pid
+    if args.start_server:
+        print(f" Starting visual search server on port {args.port}...", flush=True)
+        server = start_server(args.port)
+        server_pid = server.pid
+
+    try:
+        if not wait_for_server(url, timeout=180 if server else 10):
+            print(json.dumps({"success": False, "error": f"Visual search server not reachable at {url}"}))
+            sys.exit(1)
+
+        paths = generate_corpus(args.corpus_dir, args.images)
+        images = [(path, open(path, 'rb').read()) for path in paths]
+        random.Random(0).shuffle(images)
+        print(f" Corpus: {len(images)} images in {args.corpus_dir}", flush=True)
+
+        n_held_out = int(len(images) * HELD_OUT_FRACTION)
+        indexed, held_out = images[n_held_out:], images[:n_held_out]
+        product_ids = []
+        if (INDEX_ENDPOINTS | {'duplicates'}) & set(endpoints):
+            product_ids = seed_index(url, indexed)
+            print(f" Seeded index with {len(product_ids)} products ({len(held_out)} images held out)", flush=True)
+
+        sampler = MemorySampler(server_pid, args.sample_interval)
+        sampler.start()
+
+        results = {
+            'timestamp': datetime.now().isoformat(),
+            'url': url,
+            'config': {
+                'concurrency': args.concurrency,
+                'requestsPerEndpoint': args.requests,
+                'warmup': args.warmup,
+                'images': len(images),
+                'heldOut': len(held_out)
+            },
+            'endpoints': {}
+        }
+        for endpoint in endpoints:
+            if endpoint in INDEX_ENDPOINTS and not product_ids:
+                # Nothing was indexed (every /extract failed): there is nothing to search
+                results['endpoints'][endpoint] = {'skipped': 'index not seeded'}
+                print(f"   {endpoint:15s} skipped (index not seeded)", flush=True)
+                continue
+            if endpoint == 'search-miss' and not held_out:
+                results['endpoints'][endpoint] = {'skipped': 'no held-out images'}
+                print(f"   {endpoint:15s} skipped (no held-out images)", flush=True)
+                continue
+            query_images = indexed if endpoint in INDEX_ENDPOINTS else images
+            make_request = build_requests(endpoint, url, query_images, product_ids, held_out)
+            stats = run_endpoint(make_request, args.requests, args.concurrency, args.warmup)
+            results['endpoints'][endpoint] = stats
+            latency = stats['latencyMs']
+            print(f"   {endpoint:15s} {stats['throughputRps']:8.2f} req/s  "
+                  f"p50 {latency['p50']:8.2f} ms  p95 {latency['p95']:8.2f} ms  "
+                  f"p99 {latency['p99']:8.2f} ms  errors {stats['errors']}"
+                  + (f"  sources {stats['sources']}" if 'sources' in stats else ''), flush=True)
+
+        sampler.stop()
+        results['memory'] = sampler.samples
+
+        output = args.output or os.path.join(
+            'bench-results', f"visual_search_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n Results saved to {output}")
+
+        if args.compare:
+            compare(results, args.compare)
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,26 @@
 Integration module for Collaborative Filtering AI Model
 This provides an interface for Node.js/Express backend to call the AI model
 
-Supports 3 commands:
+Supports 9 commands:
   train    - Train model with interaction data from stdin (JSON)
+  log-append - Append interactions from stdin (JSON) to the columnar interaction log
+  train-from-log - Train model from the interaction log (optional argument: only the last N days)
   recommend - Load model and get recommendations for a user
+              (optional 4th argument: JSON filter spec, e.g. '{"in_stock": true}')
+  update-attributes - Bulk-update product attributes (stock, category, price, seller status) from stdin (JSON)
+  ab-recommend - Route the user to a model version from cf_registry.json (A/B test);
+                 same optional filter argument as recommend;
+                 per-version serving stats are only collected by main.py's long-lived registry
+  fbt-update - Add purchase/cart interactions from stdin (JSON) to the co-occurrence engine
+               (each needs a timestamp; rows without one are dropped and counted)
+  fbt      - "Frequently bought together" for a product or a comma-separated cart
   stats    - Load model and return statistics
 """
 
 import sys
 import json
 import os
+import time
 import pandas as pd
 from collaborative_filtering import CollaborativeFilteringModel
 
@@ -26,9 +37,16 @@ class CFIntegration:
     def __init__(self, model_path=None):
         """Initialize the CF model integration"""
         self.model = CollaborativeFilteringModel(n_factors=10)
-        self.model_path = model_path or os.path.join(os.path.dirname(__file__), 'cf_model.pkl')
+        self.model_path = model_path or os.environ.get(
+            'CF_MODEL_PATH', os.path.join(os.path.dirname(__file__), 'cf_model.pkl')
+        )
         self.is_initialized = False
     
+    def _carry_over_attributes(self):
+        """Keep product attributes from the previous model file across a retrain"""
+        if os.path.exists(self.model_path):
+            self.model.load_product_attributes(self.model_path)
+    
     def train_from_interactions(self, interactions_list):
         """
         Train model from a list of interaction dicts.
@@ -58,6 +76,30 @@ class CFIntegration:
         df = df.drop_duplicates(subset=['user_id', 'product_id'], keep='last')
         
         # Train model (this internally builds the user-item matrix)
+        self._carry_over_attributes()
+        self.model.train(df)
+        self.model.save_model(self.model_path)
+        self.is_initialized = True
+        
+        return True
+    
+    def train_from_log(self, log, days=None):
+        """
+        Train model from an InteractionLog instead of a full interaction dump
+        
+        Args:
+            log: InteractionLog to read
+            days: Only use interactions from the last N days (None = all history)
+        
+        Returns:
+            True if training succeeded
+        """
+        since = None if days is None else int((time.time() - days * 24 * 60 * 60) * 1000)
+        df = log.load_ratings(since=since)
+        if len(df) == 0:
+            raise ValueError("No interactions in the log for training")
+        
+        self._carry_over_attributes()
         self.model.train(df)
         self.model.save_model(self.model_path)
         self.is_initialized = True
@@ -72,19 +114,29 @@ class CFIntegration:
         self.model.load_model(self.model_path)
         self.is_initialized = True
     
-    def get_recommendations(self, user_id, num_recommendations=5):
-        """Get personalized recommendations for a user"""
+    def get_recommendations(self, user_id, num_recommendations=5, filters=None):
+        """Get personalized recommendations for a user, optionally filtered by business rules"""
         if not self.is_initialized:
             raise ValueError("Model not initialized. Call train or load first.")
         
         recommendations = self.model.recommend_products(
             user_id, 
             n_recommendations=num_recommendations,
-            exclude_rated=True
+            exclude_rated=True,
+            filters=filters
         )
         
         return recommendations
     
+    def update_product_attributes(self, products):
+        """Bulk-update product attributes and persist them with the model"""
+        if not self.is_initialized:
+            raise ValueError("Model not initialized. Call train or load first.")
+        
+        updated = self.model.update_product_attributes(products)
+        self.model.save_model(self.model_path)
+        return updated
+    
     def get_model_stats(self):
         """Get model statistics"""
         return self.model.get_model_stats()
@@ -127,9 +179,37 @@ if __name__ == "__main__":
             stats = cf.get_model_stats()
             print(json.dumps({"success": True, "stats": stats}))
         
+        elif command == "log-append":
+            from interaction_log import InteractionLog
+            
+            input_data = json.loads(sys.stdin.read())
+            interactions = input_data.get('interactions', [])
+            
+            log = InteractionLog()
+            rows = log.append(interactions)
+            
+            print(json.dumps({"success": True, "rows": rows, "stats": log.get_stats()}))
+        
+        elif command == "train-from-log":
+            from interaction_log import InteractionLog
+            
+            days = float(sys.argv[2]) if len(sys.argv) > 2 else None
+            
+            sys.stdout = SuppressPrint()
+            sys.stderr = SuppressPrint()
+            
+            cf.train_from_log(InteractionLog(), days)
+            
+            sys.stdout = old_stdout
+            sys.stderr = old_stderr
+            
+            stats = cf.get_model_stats()
+            print(json.dumps({"success": True, "stats": stats}))
+        
         elif command == "recommend":
             user_id = sys.argv[2] if len(sys.argv) > 2 else None
             num_recs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+            filters = json.loads(sys.argv[4]) if len(sys.argv) > 4 else None
             
             if not user_id:
                 print(json.dumps({"error": "No user_id specified"}))
@@ -140,7 +220,7 @@ if __name__ == "__main__":
             sys.stderr = SuppressPrint()
             
             cf.load_existing_model()
-            recommendations = cf.get_recommendations(user_id, num_recs)
+            recommendations = cf.get_recommendations(user_id, num_recs, filters)
             
             sys.stdout = old_stdout
             sys.stderr = old_stderr
@@ -155,6 +235,115 @@ if __name__ == "__main__":
             }
             print(json.dumps(result))
         
+        elif command == "update-attributes":
+            input_data = json.loads(sys.stdin.read())
+            products = input_data.get('products', [])
+            
+            sys.stdout = SuppressPrint()
+            sys.stderr = SuppressPrint()
+            
+            cf.load_existing_model()
+            updated = cf.update_product_attributes(products)
+            
+            sys.stdout = old_stdout
+            sys.stderr = old_stderr
+            
+            print(json.dumps({"success": True, "updated": updated}))
+        
+        elif command == "ab-recommend":
+            from cf_model_registry import ModelRegistry
+            
+            user_id = sys.argv[2] if len(sys.argv) > 2 else None
+            num_recs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+            filters = json.loads(sys.argv[4]) if len(sys.argv) > 4 else None
+            registry_path = os.environ.get(
+                'CF_REGISTRY_PATH', os.path.join(os.path.dirname(__file__), 'cf_registry.json')
+            )
+            
+            if not user_id:
+                print(json.dumps({"error": "No user_id specified"}))
+                sys.exit(1)
+            if not os.path.exists(registry_path):
+                print(json.dumps({"error": f"Registry config not found: {registry_path}"}))
+                sys.exit(1)
+            
+            sys.stdout = SuppressPrint()
+            sys.stderr = SuppressPrint()
+            
+            # One-shot process: no array sharing/hashing, and its stats would be discarded anyway
+            registry = ModelRegistry.from_config(registry_path, share_arrays=False)
+            version, recommendations = registry.recommend(user_id, num_recs, filters=filters)
+            
+            sys.stdout = old_stdout
+            sys.stderr = old_stderr
+            
+            result = {
+                "success": True,
+                "user_id": user_id,
+                "model_version": version,
+                "recommendations": [
+                    {"product_id": pid, "predicted_rating": float(rating)}
+                    for pid, rating in recommendations
+                ]
+            }
+            print(json.dumps(result))
+        
+        elif command == "fbt-update":
+            from cooccurrence import CooccurrenceEngine
+            
+            input_data = json.loads(sys.stdin.read())
+            interactions = input_data.get('interactions', [])
+            engine_path = os.path.join(os.path.dirname(__file__), 'cooccurrence.pkl')
+            
+            engine = CooccurrenceEngine()
+            if os.path.exists(engine_path):
+                engine.load_model(engine_path)
+            
+            dropped_before = engine.dropped_untimed
+            try:
+                sessions = engine.update(interactions)
+            except ValueError as e:
+                # e.g. interactions fetched without their timestamp field
+                print(json.dumps({"error": f"fbt-update rejected the batch: {str(e)}"}))
+                sys.exit(1)
+            engine.save_model(engine_path)
+            
+            print(json.dumps({
+                "success": True,
+                "sessions": sessions,
+                "dropped_untimed": engine.dropped_untimed - dropped_before,
+                "stats": engine.get_stats()
+            }))
+        
+        elif command == "fbt":
+            from cooccurrence import CooccurrenceEngine
+            
+            product_ids = sys.argv[2].split(',') if len(sys.argv) > 2 else []
+            num_recs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+            engine_path = os.path.join(os.path.dirname(__file__), 'cooccurrence.pkl')
+            
+            if not product_ids:
+                print(json.dumps({"error": "No product_id specified"}))
+                sys.exit(1)
+            if not os.path.exists(engine_path):
+                raise FileNotFoundError("Co-occurrence data not found. Run fbt-update first.")
+            
+            engine = CooccurrenceEngine().load_model(engine_path)
+            if len(product_ids) == 1:
+                related = engine.frequently_bought_together(product_ids[0], num_recs)
+            else:
+                related = engine.recommend_for_cart(product_ids, num_recs)
+            
+            result = {
+                "success": True,
+                "product_ids": product_ids,
+                "recommendations": [
+                    {"product_id": pid, "count": count}
+                    for pid, count in related
+                ]
+            }
+            print(json.dumps(result))
+        
         elif command == "stats":
             sys.stdout = SuppressPrint()
             sys.stderr = SuppressPrint()
@@ -0,0 +1,258 @@
+"""
+Model Registry for Collaborative Filtering A/B tests
+Keeps several named CF model versions loaded in one process and routes each
+user to a version deterministically, so two factorizations can be compared
+without running two deployments.
+
+- Routing: sha256(user_id) picks a bucket in [0, 10000); buckets are split
+  between versions by weight, so a user always sees the same version
+- Sharing: user/product id tables that are identical across versions are
+  loaded once, and the large arrays (SVD components, user factors, user-item
+  matrix) are written once per distinct content to .npy files and memory-mapped
+  read-only, so identical arrays are backed by the same pages. Cached .npy
+  files this registry wrote that no registered version uses any more (e.g.
+  from before a retrain) are deleted on register/unregister; files written by
+  other processes sharing the cache directory are left alone
+- Stats: requests, latency percentiles and result stats per version, kept in
+  memory for the lifetime of the registry (i.e. the main.py process)
+- share_arrays=False skips the content hashing and the .npy cache, for
+  short-lived processes that load the models once (cf_integration.py ab-recommend)
+
+Registry config (JSON):
+  {"versions": [{"name": "A", "path": "cf_model.pkl", "weight": 50},
+                {"name": "B", "path": "cf_model_v2.pkl", "weight": 50}]}
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from collaborative_filtering import CollaborativeFilteringModel
+
+ROUTING_BUCKETS = 10000
+
+
+def routing_bucket(user_id):
+    """Deterministic bucket in [0, ROUTING_BUCKETS) for a user id."""
+    digest = hashlib.sha256(str(user_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % ROUTING_BUCKETS
+
+
+class VersionStats:
+    def __init__(self, window=1000):
+        """Request/latency/result counters for one model version."""
+        self.requests = 0
+        self.empty_results = 0
+        self.items_returned = 0
+        self.rating_sum = 0.0
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, recommendations):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+            if not recommendations:
+                self.empty_results += 1
+            self.items_returned += len(recommendations)
+            self.rating_sum += sum(float(rating) for _, rating in recommendations)
+
+    def to_dict(self):
+        with self._lock:
+            latencies_ms = np.array(self.latencies) * 1000
+            return {
+                'requests': self.requests,
+                'emptyResults': self.empty_results,
+                'meanResults': round(self.items_returned / self.requests, 2) if self.requests else 0.0,
+                'meanPredictedRating': round(self.rating_sum / self.items_returned, 3) if self.items_returned else None,
+                'latencyMs': {
+                    'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+                    'p95': round(float(np.percentile(latencies_ms, 95)), 3),
+                    'p99': round(float(np.percentile(latencies_ms, 99)), 3)
+                } if len(latencies_ms) else None
+            }
+
+
+class ModelRegistry:
+    def __init__(self, cache_dir=None, share_arrays=True):
+        """
+        Args:
+            cache_dir: Where shared arrays are written as .npy for memory mapping
+                       (default: cf_registry_cache/ next to this file)
+            share_arrays: Deduplicate and memory-map arrays by content; False keeps
+                          each version's arrays as loaded (no hashing, no disk writes)
+        """
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cf_registry_cache')
+        self.share_arrays = share_arrays
+        self.versions = {}      # name -> CollaborativeFilteringModel
+        self.weights = {}       # name -> routing weight
+        self.paths = {}         # name -> model path
+        self.stats = {}         # name -> VersionStats
+        self._id_tables = {}    # content digest -> (ids list, {id: position})
+        self._arrays = {}       # content digest -> read-only memmap
+        self._version_digests = {}  # name -> digests of the id tables/arrays it uses
+        self._written = set()   # digests of the cached .npy files this registry wrote
+        self._routes = []       # [(upper bucket bound, name)]
+
+    @classmethod
+    def from_config(cls, config_path, cache_dir=None, share_arrays=True):
+        """Build a registry from a JSON config file (see module docstring)."""
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        registry = cls(cache_dir=cache_dir, share_arrays=share_arrays)
+        base_dir = os.path.dirname(os.path.abspath(config_path))
+        for version in config.get('versions', []):
+            path = version['path']
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            registry.register(version['name'], path, version.get('weight', 1))
+        return registry
+
+    def _shared_ids(self, ids):
+        """Return (digest, shared (ids, index) pair) for an id table, reusing an identical one."""
+        digest = hashlib.sha1('\x00'.join(map(str, ids)).encode('utf-8')).hexdigest()
+        if digest not in self._id_tables:
+            self._id_tables[digest] = (list(ids), {item: i for i, item in enumerate(ids)})
+        return digest, self._id_tables[digest]
+
+    def _shared_array(self, array):
+        """Return (digest, read-only memory-mapped copy of an array), shared by content."""
+        array = np.ascontiguousarray(array)
+        hasher = hashlib.sha1()
+        hasher.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+        hasher.update(array.tobytes())
+        digest = hasher.hexdigest()
+
+        if digest not in self._arrays:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f'{digest}.npy')
+            for _ in range(2):
+                if not os.path.exists(path):
+                    tmp_path = f'{path}.{os.getpid()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, array)
+                    os.replace(tmp_path, path)
+                    self._written.add(digest)
+                try:
+                    self._arrays[digest] = np.load(path, mmap_mode='r')
+                    break
+                except FileNotFoundError:
+                    # Collected by another registry process in between: write it again
+                    continue
+        return digest, self._arrays[digest]
+
+    def _collect_garbage(self):
+        """Drop unused id tables/arrays and delete the .npy files this registry wrote for them."""
+        used = set().union(*self._version_digests.values())
+        for table in (self._id_tables, self._arrays):
+            for digest in list(table):
+                if digest not in used:
+                    del table[digest]
+        for digest in self._written - used:
+            try:
+                # Other processes keep their existing mappings of an unlinked file
+                os.remove(os.path.join(self.cache_dir, f'{digest}.npy'))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # e.g. Windows refuses to delete a file that is still mapped: retry next pass
+                continue
+            self._written.discard(digest)
+
+    def register(self, name, model_path, weight=1):
+        """Load a model version and (re)build the routing table."""
+        model = CollaborativeFilteringModel()
+        model.load_model(model_path)
+
+        user_digest, (model.user_ids, model.user_index) = self._shared_ids(model.user_ids)
+        product_digest, (model.product_ids, model.product_index) = self._shared_ids(model.product_ids)
+        self._version_digests[name] = {user_digest, product_digest}
+        if self.share_arrays:
+            components_digest, model.svd_model.components_ = self._shared_array(model.svd_model.components_)
+            factors_digest, model.user_factors = self._shared_array(model.user_factors)
+            matrix = model.user_item_matrix
+            matrix_digest, values = self._shared_array(matrix.values)
+            model.user_item_matrix = pd.DataFrame(values, index=matrix.index, columns=matrix.columns, copy=False)
+            self._version_digests[name] |= {components_digest, factors_digest, matrix_digest}
+
+        self.versions[name] = model
+        self.weights[name] = weight
+        self.paths[name] = model_path
+        self.stats[name] = VersionStats()
+        self._rebuild_routes()
+        self._collect_garbage()
+        return model
+
+    def unregister(self, name):
+        for table in (self.versions, self.weights, self.paths, self.stats, self._version_digests):
+            table.pop(name, None)
+        self._rebuild_routes()
+        self._collect_garbage()
+
+    def _rebuild_routes(self):
+        total = sum(weight for weight in self.weights.values() if weight > 0)
+        self._routes = []
+        if total <= 0:
+            return
+        upper = 0.0
+        for name in sorted(self.weights):
+            if self.weights[name] <= 0:
+                continue
+            upper += self.weights[name] / total * ROUTING_BUCKETS
+            self._routes.append((upper, name))
+        # Guard against float rounding leaving the last bucket unassigned
+        self._routes[-1] = (ROUTING_BUCKETS, self._routes[-1][1])
+
+    def route(self, user_id):
+        """Name of the version serving this user."""
+        if not self._routes:
+            raise ValueError("No model versions registered")
+        bucket = routing_bucket(user_id)
+        for upper, name in self._routes:
+            if bucket < upper:
+                return name
+        return self._routes[-1][1]
+
+    def recommend(self, user_id, n_recommendations=5, version=None, **kwargs):
+        """
+        Recommend with the user's routed version (or an explicit one)
+
+        Returns:
+            (version name, list of (product_id, predicted_rating))
+        """
+        name = version or self.route(user_id)
+        model = self.versions[name]
+
+        started = time.perf_counter()
+        recommendations = model.recommend_products(user_id, n_recommendations=n_recommendations, **kwargs)
+        self.stats[name].record(time.perf_counter() - started, recommendations)
+
+        return name, recommendations
+
+    def get_stats(self):
+        """Per-version routing share, model stats and serving stats."""
+        total = sum(weight for weight in self.weights.values() if weight > 0)
+        return {
+            name: {
+                'path': self.paths[name],
+                'trafficShare': round(self.weights[name] / total, 4) if total and self.weights[name] > 0 else 0.0,
+                'model': self.versions[name].get_model_stats(),
+                'serving': self.stats[name].to_dict()
+            }
+            for name in sorted(self.versions)
+        }
+
+    def shared_memory_report(self):
+        """How many distinct id tables / arrays back the loaded versions."""
+        return {
+            'versions': len(self.versions),
+            'distinctIdTables': len(self._id_tables),
+            'distinctArrays': len(self._arrays),
+            'mappedBytes': int(sum(array.nbytes for array in self._arrays.values()))
+        }
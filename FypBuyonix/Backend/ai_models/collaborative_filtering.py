@@ -42,9 +42,14 @@ class CollaborativeFilteringModel:
         """
         self.n_factors = n_factors
         self.svd_model = None
+        self.user_factors = None
         self.user_item_matrix = None
         self.product_ids = None
         self.user_ids = None
+        self.user_index = {}
+        self.product_index = {}
+        self.product_attributes = {}
+        self.category_codes = {}
         self.is_trained = False
         self.training_date = None
         
@@ -116,9 +121,13 @@ class CollaborativeFilteringModel:
             fill_value=0  # 0 = not rated
         )
         
+        previous_attributes = self._export_product_attributes()
+        
         self.user_item_matrix = matrix
         self.user_ids = matrix.index.tolist()
         self.product_ids = matrix.columns.tolist()
+        self._build_id_index()
+        self._init_product_attributes(previous_attributes)
         
         sparsity = (matrix == 0).sum().sum() / (matrix.shape[0] * matrix.shape[1])
         print(f" Matrix shape: {matrix.shape} (Users × Products)")
@@ -154,6 +163,8 @@ class CollaborativeFilteringModel:
         
         self.svd_model = TruncatedSVD(n_components=actual_n_factors, random_state=42)
         self.svd_model.fit(self.user_item_matrix.values)
+        # U·Σ: one latent vector per user (components_ holds the product vectors)
+        self.user_factors = self.svd_model.transform(self.user_item_matrix.values)
         
         # Step 3: Calculate explained variance
         explained_var = self.svd_model.explained_variance_ratio_.sum()
@@ -170,6 +181,140 @@ class CollaborativeFilteringModel:
         
         return self
     
+    def _build_id_index(self):
+        """Map user/product ids to matrix positions (O(1) lookups instead of list.index)"""
+        self.user_index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        self.product_index = {product_id: i for i, product_id in enumerate(self.product_ids)}
+    
+    def _init_product_attributes(self, previous=None):
+        """
+        Per-product attribute arrays aligned with product_ids
+        - in_stock / seller_active: bool (default True until told otherwise)
+        - category: int32 code into category_codes (-1 = unknown)
+        - price: float32 (NaN = unknown)
+        Attributes from a previous training run are carried over by product id.
+        """
+        n = len(self.product_ids)
+        self.product_attributes = {
+            'in_stock': np.ones(n, dtype=bool),
+            'seller_active': np.ones(n, dtype=bool),
+            'category': np.full(n, -1, dtype=np.int32),
+            'price': np.full(n, np.nan, dtype=np.float32)
+        }
+        if previous:
+            self.update_product_attributes(previous)
+    
+    def _export_product_attributes(self):
+        """Attribute records in update_product_attributes format (for carry-over)."""
+        if not self.product_attributes or not self.product_ids:
+            return []
+        categories = {code: name for name, code in self.category_codes.items()}
+        attrs = self.product_attributes
+        return [
+            {
+                'productId': product_id,
+                'inStock': bool(attrs['in_stock'][i]),
+                'sellerActive': bool(attrs['seller_active'][i]),
+                'category': categories.get(int(attrs['category'][i])),
+                'price': None if np.isnan(attrs['price'][i]) else float(attrs['price'][i])
+            }
+            for i, product_id in enumerate(self.product_ids)
+        ]
+    
+    def update_product_attributes(self, products):
+        """
+        Bulk-update product attributes used by recommendation filters
+        
+        Args:
+            products: List of {productId, inStock?, sellerActive?, category?, price?} dicts;
+                      missing keys are left unchanged, unknown products are ignored
+        
+        Returns:
+            Number of records applied to known products
+        """
+        if not self.product_attributes:
+            self._init_product_attributes()
+        
+        df = pd.DataFrame(list(products))
+        if df.empty or 'productId' not in df:
+            return 0
+        
+        positions = df['productId'].map(self.product_index)
+        known = positions.notna().to_numpy()
+        df = df[known]
+        positions = positions[known].astype(np.int64).to_numpy()
+        attrs = self.product_attributes
+        
+        columns = [('inStock', 'in_stock', bool), ('sellerActive', 'seller_active', bool), ('price', 'price', np.float32)]
+        for column, name, dtype in columns:
+            if column in df:
+                values = df[column]
+                present = values.notna().to_numpy()
+                attrs[name][positions[present]] = values[present].to_numpy().astype(dtype)
+        
+        if 'category' in df:
+            values = df['category']
+            present = values.notna().to_numpy()
+            codes = [
+                self.category_codes.setdefault(str(c).lower().strip(), len(self.category_codes))
+                for c in values[present]
+            ]
+            attrs['category'][positions[present]] = codes
+        
+        return int(known.sum())
+    
+    def _filter_mask(self, filters):
+        """
+        Boolean mask over product_ids for a filter spec
+        
+        Supported keys:
+            in_stock: True -> only in-stock products
+            seller_active: True -> only products of active sellers
+            categories / exclude_categories: lists of category names
+            min_price / max_price: price range (unknown prices are excluded)
+            exclude_products: list of product ids
+        """
+        if not self.product_attributes:
+            self._init_product_attributes()
+        
+        attrs = self.product_attributes
+        mask = np.ones(len(self.product_ids), dtype=bool)
+        
+        if filters.get('in_stock'):
+            mask &= attrs['in_stock']
+        if filters.get('seller_active'):
+            mask &= attrs['seller_active']
+        if filters.get('categories') is not None:
+            codes = [self.category_codes.get(str(c).lower().strip(), -2) for c in filters['categories']]
+            mask &= np.isin(attrs['category'], codes)
+        if filters.get('exclude_categories'):
+            codes = [self.category_codes.get(str(c).lower().strip(), -2) for c in filters['exclude_categories']]
+            mask &= ~np.isin(attrs['category'], codes)
+        if filters.get('min_price') is not None:
+            mask &= attrs['price'] >= float(filters['min_price'])
+        if filters.get('max_price') is not None:
+            mask &= attrs['price'] <= float(filters['max_price'])
+        if filters.get('exclude_products'):
+            excluded = [self.product_index[p] for p in filters['exclude_products'] if p in self.product_index]
+            mask[excluded] = False
+        
+        return mask
+    
+    def _predict_scores(self, user_idx, product_idx):
+        """
+        Predicted ratings for one user and an array of product positions
+        
+        The raw scores (user vector · product vectors) are min-max normalised over
+        all of the user's products onto the 1-5 rating scale, so they keep their
+        spread instead of collapsing onto the clip bounds. A user whose scores are
+        all equal gets a neutral 3.
+        """
+        raw = self.user_factors[user_idx] @ self.svd_model.components_
+        low, high = raw.min(), raw.max()
+        if high - low <= 1e-12:
+            return np.full(np.shape(product_idx), 3.0)
+        return 1 + 4 * (raw[product_idx] - low) / (high - low)
+    
     def predict_rating(self, user_id, product_id):
         """
         Predict rating for a user-product pair
@@ -179,47 +324,69 @@ class CollaborativeFilteringModel:
         2. Get product latent feature vector from V matrix
         3. Multiply them to get predicted rating
         
-        Returns: Predicted rating (1-5 scale, clipped)
+        Returns: Predicted rating (1-5 scale, min-max normalised per user)
         """
         if not self.is_trained:
             raise ValueError("Model must be trained first!")
         
         # Handle users/products not in training data
-        if user_id not in self.user_ids:
+        if user_id not in self.user_index:
             return None
-        if product_id not in self.product_ids:
+        if product_id not in self.product_index:
             return None
         
-        user_idx = self.user_ids.index(user_id)
-        product_idx = self.product_ids.index(product_id)
+        user_idx = self.user_index[user_id]
+        product_idx = self.product_index[product_id]
         
-        # Get latent factors
-        user_factors = self.svd_model.components_[:, user_idx]
-        product_factors = self.svd_model.components_[:, product_idx]
+        # Predict rating (dot product of latent vectors, normalised to [1, 5])
+        predicted = self._predict_scores(user_idx, product_idx)
         
-        # Predict rating (dot product of latent vectors)
-        predicted = np.dot(user_factors, product_factors)
+        return round(predicted, 2)
+    
+    def score_products(self, user_id, product_ids):
+        """
+        Predict ratings for many products in one vectorized pass
         
-        # Clip to valid rating range [1, 5]
-        predicted = np.clip(predicted, 1, 5)
+        Args:
+            user_id: User to score for
+            product_ids: Sequence of product ids (any order, may contain unknown ids)
         
-        return round(predicted, 2)
+        Returns:
+            float array aligned with product_ids, NaN where the user or product
+            is not in the training data
+        """
+        if not self.is_trained:
+            raise ValueError("Model must be trained first!")
+        
+        scores = np.full(len(product_ids), np.nan)
+        user_idx = self.user_index.get(user_id)
+        if user_idx is None:
+            return scores
+        
+        positions = np.array([self.product_index.get(pid, -1) for pid in product_ids], dtype=np.int64)
+        known = positions >= 0
+        if known.any():
+            scores[known] = self._predict_scores(user_idx, positions[known])
+        return scores
     
-    def recommend_products(self, user_id, n_recommendations=5, exclude_rated=True):
+    def recommend_products(self, user_id, n_recommendations=5, exclude_rated=True, filters=None):
         """
         Recommend top N products for a user
         
         Algorithm:
         1. Get all products (rated or unrated) for user
         2. Predict ratings for all products
-        3. If exclude_rated is True, remove already-rated products
-        4. Sort by predicted rating
-        5. Return top N
+        3. Drop products failing the business-rule filters (boolean mask)
+        4. If exclude_rated is True, remove already-rated products
+        5. Sort by predicted rating
+        6. Return top N
         
         Args:
             user_id: User to generate recommendations for
             n_recommendations: Number of products to recommend
             exclude_rated: If True, exclude products already rated by user
+            filters: Optional filter spec (see _filter_mask), applied before top-N
+                     so every returned product is valid
         
         Returns:
             List of (product_id, predicted_rating) tuples
@@ -227,35 +394,30 @@ class CollaborativeFilteringModel:
         if not self.is_trained:
             raise ValueError("Model must be trained first!")
         
-        if user_id not in self.user_ids:
+        if user_id not in self.user_index:
             return []
         
-        user_idx = self.user_ids.index(user_id)
-        user_ratings = self.user_item_matrix.iloc[user_idx]
+        user_idx = self.user_index[user_id]
         
-        predictions = []
+        # Predict ratings for every product at once
+        all_products = np.arange(len(self.product_ids))
+        predictions = np.round(self._predict_scores(user_idx, all_products), 2)
         
-        for product_id in self.product_ids:
-            # Skip if user already rated this product (if exclude_rated is True)
-            if exclude_rated and user_ratings[product_id] > 0:
-                continue
-            
-            # Predict rating
-            predicted_rating = self.predict_rating(user_id, product_id)
-            if predicted_rating is not None:
-                predictions.append((product_id, predicted_rating))
-        
-        # If no unrated products, return top-rated products anyway
-        if len(predictions) == 0 and exclude_rated:
-            for product_id in self.product_ids:
-                predicted_rating = self.predict_rating(user_id, product_id)
-                if predicted_rating is not None:
-                    predictions.append((product_id, predicted_rating))
+        # Keep only products passing the business rules
+        valid = self._filter_mask(filters) if filters else np.ones(len(all_products), dtype=bool)
+        candidates = all_products[valid]
+        
+        # Skip products the user already rated (if exclude_rated is True)
+        if exclude_rated:
+            unrated = valid & (self.user_item_matrix.values[user_idx] == 0)
+            # If no unrated products, return top-rated products anyway
+            if unrated.any():
+                candidates = all_products[unrated]
         
         # Sort by predicted rating (descending)
-        predictions.sort(key=lambda x: x[1], reverse=True)
+        order = candidates[np.argsort(-predictions[candidates], kind='stable')]
         
-        return predictions[:n_recommendations]
+        return [(self.product_ids[i], predictions[i]) for i in order[:n_recommendations]]
     
     def get_model_stats(self):
         """Return model statistics for reporting"""
@@ -282,11 +444,14 @@ class CollaborativeFilteringModel:
         
         model_data = {
             'svd_model': self.svd_model,
+            'user_factors': self.user_factors,
             'user_item_matrix': self.user_item_matrix,
             'user_ids': self.user_ids,
             'product_ids': self.product_ids,
             'n_factors': self.n_factors,
-            'training_date': self.training_date
+            'training_date': self.training_date,
+            'product_attributes': self.product_attributes,
+            'category_codes': self.category_codes
         }
         
         with open(filepath, 'wb') as f:
@@ -301,13 +466,42 @@ class CollaborativeFilteringModel:
         
         self.svd_model = model_data['svd_model']
         self.user_item_matrix = model_data['user_item_matrix']
+        # Models saved before user factors were stored: recompute them from the matrix
+        self.user_factors = model_data.get('user_factors')
+        if self.user_factors is None:
+            self.user_factors = self.svd_model.transform(self.user_item_matrix.values)
         self.user_ids = model_data['user_ids']
         self.product_ids = model_data['product_ids']
         self.n_factors = model_data['n_factors']
         self.training_date = model_data['training_date']
+        self._build_id_index()
+        # Models saved before attribute filtering existed get defaults
+        self.category_codes = model_data.get('category_codes', {})
+        if model_data.get('product_attributes'):
+            self.product_attributes = model_data['product_attributes']
+        else:
+            self._init_product_attributes()
         self.is_trained = True
         
         print(f" Model loaded from {filepath}")
+    
+    def load_product_attributes(self, filepath):
+        """
+        Load only the product attributes of a saved model, so a retrain
+        (which starts from a fresh model) carries stock/seller/category/price over
+        
+        Returns:
+            Number of products with attributes loaded
+        """
+        with open(filepath, 'rb') as f:
+            model_data = pickle.load(f)
+        
+        if not model_data.get('product_attributes'):
+            return 0
+        self.product_ids = model_data['product_ids']
+        self.product_attributes = model_data['product_attributes']
+        self.category_codes = model_data.get('category_codes', {})
+        return len(self.product_ids)
 
 
 # Main execution
@@ -0,0 +1,278 @@
+"""
+Item-Item Co-occurrence Engine ("Frequently Bought Together")
+Counts how often two products end up in the same purchase/cart session,
+as a sparse C = Xᵀ·X where X is the binary session × product matrix.
+
+- Sessions: a user's purchase/cart events with no gap longer than
+  session_gap_minutes between them
+- Incremental: a new batch only adds ΔC = X_newᵀX_new + X_oldᵀX_new + X_newᵀX_old,
+  where X_new holds the products a session gained in this batch and X_old the
+  products it already had (sessions still open from the previous batch)
+- Bounded memory: each row keeps only its top (top_k * slack) counts; the
+  min_count threshold is applied when serving, so pairs can still accumulate
+  across batches before they qualify
+- Serving: one CSR row lookup per product, or the summed rows of a cart
+"""
+
+import os
+import pickle
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+DEFAULT_ACTIONS = ('purchase', 'cart')
+
+
+def to_millis(timestamps):
+    """Epoch milliseconds from numbers (already ms) and/or ISO date strings (a pandas Series)."""
+    millis = pd.to_numeric(timestamps, errors='coerce')
+    is_text = millis.isna()
+    if is_text.any():
+        parsed = pd.to_datetime(timestamps[is_text], utc=True, format='ISO8601')
+        millis[is_text] = (parsed - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+    return millis.astype(np.int64).to_numpy()
+
+
+class CooccurrenceEngine:
+    def __init__(self, top_k=50, min_count=2, session_gap_minutes=30, slack=2, actions=DEFAULT_ACTIONS):
+        """
+        Initialize an empty co-occurrence engine
+
+        Args:
+            top_k: Most related products served per product
+            min_count: Minimum co-occurrence count for a pair to be served
+            session_gap_minutes: Inactivity gap that closes a session
+            slack: Rows keep top_k * slack entries so rankings survive pruning
+            actions: Interaction actions that count as "bought together"
+        """
+        self.top_k = top_k
+        self.min_count = min_count
+        self.session_gap_ms = int(session_gap_minutes * 60 * 1000)
+        self.slack = slack
+        self.actions = tuple(actions)
+        self.product_ids = []
+        self.product_index = {}
+        self.matrix = sp.csr_matrix((0, 0), dtype=np.float32)
+        self.open_sessions = {}   # user_id -> (last timestamp ms, array of product codes)
+        self.n_sessions = 0
+        self.dropped_untimed = 0
+        self.updated_at = None
+
+    def _encode_products(self, product_ids):
+        """Map product ids to codes, appending unseen ones."""
+        codes = np.empty(len(product_ids), dtype=np.int64)
+        for i, product_id in enumerate(product_ids):
+            code = self.product_index.get(product_id)
+            if code is None:
+                code = len(self.product_ids)
+                self.product_index[product_id] = code
+                self.product_ids.append(product_id)
+            codes[i] = code
+        return codes
+
+    def update(self, interactions):
+        """
+        Add a batch of interactions without recomputing from scratch
+
+        Args:
+            interactions: List of {userId, productId, action, timestamp} dicts
+                          (or a DataFrame with those columns); rows without a
+                          timestamp are dropped and counted in dropped_untimed
+
+        Raises:
+            ValueError: If no purchase/cart row in the batch has a timestamp
+
+        Returns:
+            Number of sessions touched by the batch
+        """
+        df = pd.DataFrame(interactions)
+        if df.empty:
+            return 0
+        df = df[df['action'].isin(self.actions)]
+        if df.empty:
+            return 0
+
+        # Without a timestamp an event cannot be placed in a session
+        timed = df['timestamp'].notna() if 'timestamp' in df else pd.Series(False, index=df.index)
+        if not timed.any():
+            raise ValueError(
+                f"Interactions need a timestamp to be split into sessions "
+                f"(none of the {len(df)} {'/'.join(self.actions)} rows had one)"
+            )
+        self.dropped_untimed += int((~timed).sum())
+        df = df[timed]
+
+        df = pd.DataFrame({
+            'user': df['userId'].astype(str).to_numpy(),
+            'item': self._encode_products(df['productId'].astype(str).tolist()),
+            'ts': to_millis(df['timestamp'])
+        }).sort_values(['user', 'ts'], kind='stable').reset_index(drop=True)
+
+        users = df['user'].to_numpy()
+        timestamps = df['ts'].to_numpy()
+        first_of_user = np.r_[True, users[1:] != users[:-1]]
+        gap_break = np.r_[True, np.diff(timestamps) > self.session_gap_ms]
+        session = np.cumsum(first_of_user | gap_break) - 1
+        n_sessions = int(session[-1]) + 1
+
+        # Per session: owner, first/last timestamp, and whether it continues an open session
+        starts = np.flatnonzero(np.r_[True, np.diff(session) != 0])
+        session_user = users[starts]
+        session_first_ts = timestamps[starts]
+        session_last_ts = np.maximum.reduceat(timestamps, starts)
+
+        old_rows, old_items = [], []
+        for s in np.flatnonzero(first_of_user[starts]):
+            state = self.open_sessions.get(session_user[s])
+            if state is not None and session_first_ts[s] - state[0] <= self.session_gap_ms:
+                old_rows.append(np.full(len(state[1]), s, dtype=np.int64))
+                old_items.append(state[1])
+        old_rows = np.concatenate(old_rows) if old_rows else np.zeros(0, dtype=np.int64)
+        old_items = np.concatenate(old_items) if old_items else np.zeros(0, dtype=np.int64)
+
+        n_items = len(self.product_ids)
+        new_keys = np.unique(session * n_items + df['item'].to_numpy())
+        old_keys = old_rows * n_items + old_items
+        new_keys = new_keys[~np.isin(new_keys, old_keys)]
+        new_rows, new_items = new_keys // n_items, new_keys % n_items
+
+        def session_matrix(rows, items):
+            data = np.ones(len(rows), dtype=np.float32)
+            return sp.csr_matrix((data, (rows, items)), shape=(n_sessions, n_items))
+
+        x_new = session_matrix(new_rows, new_items)
+        x_old = session_matrix(old_rows, old_items)
+        delta = (x_new.T @ x_new + x_old.T @ x_new + x_new.T @ x_old).tocsr()
+        delta.setdiag(0)
+        delta.eliminate_zeros()
+
+        matrix = self.matrix
+        if matrix.shape[0] < n_items:
+            matrix = sp.csr_matrix(
+                (matrix.data, matrix.indices, np.r_[matrix.indptr, np.full(n_items - matrix.shape[0], matrix.nnz)]),
+                shape=(n_items, n_items)
+            )
+        self.matrix = self._prune(matrix + delta)
+
+        # Remember each user's latest session so the next batch can extend it
+        all_items = x_old + x_new
+        latest = {}
+        for s, user in enumerate(session_user):
+            latest[user] = s
+        for user, s in latest.items():
+            row = all_items.getrow(s)
+            self.open_sessions[user] = (int(session_last_ts[s]), row.indices.astype(np.int64))
+
+        # Sessions idle for longer than the gap can never be extended again
+        horizon = int(timestamps.max()) - self.session_gap_ms
+        self.open_sessions = {u: state for u, state in self.open_sessions.items() if state[0] >= horizon}
+
+        self.n_sessions += n_sessions - len(np.unique(old_rows))
+        self.updated_at = datetime.now().isoformat()
+        return n_sessions
+
+    def _prune(self, matrix):
+        """Keep the top (top_k * slack) counts of every row, vectorized over the whole CSR."""
+        matrix = matrix.tocsr()
+        matrix.eliminate_zeros()
+        keep_k = self.top_k * self.slack
+        row_lengths = np.diff(matrix.indptr)
+        if row_lengths.size == 0 or row_lengths.max() <= keep_k:
+            return matrix
+
+        rows = np.repeat(np.arange(matrix.shape[0]), row_lengths)
+        order = np.lexsort((-matrix.data, rows))
+        rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+        keep = order[rank < keep_k]
+        keep.sort()
+
+        return sp.csr_matrix(
+            (matrix.data[keep], (rows[keep], matrix.indices[keep])),
+            shape=matrix.shape
+        )
+
+    def _top(self, product_codes, scores, n, exclude=()):
+        mask = scores >= self.min_count
+        if exclude:
+            mask &= ~np.isin(product_codes, list(exclude))
+        product_codes, scores = product_codes[mask], scores[mask]
+        order = np.lexsort((product_codes, -scores))[:n]
+        return [(self.product_ids[product_codes[i]], float(scores[i])) for i in order]
+
+    def frequently_bought_together(self, product_id, n=10):
+        """
+        Products most often bought/carted together with one product
+
+        Returns:
+            List of (product_id, co-occurrence count) sorted by count
+        """
+        code = self.product_index.get(product_id)
+        if code is None or code >= self.matrix.shape[0]:
+            return []
+        start, end = self.matrix.indptr[code], self.matrix.indptr[code + 1]
+        return self._top(self.matrix.indices[start:end], self.matrix.data[start:end], min(n, self.top_k))
+
+    def recommend_for_cart(self, product_ids, n=10):
+        """
+        Complete-the-cart suggestions: summed co-occurrence rows of the cart items,
+        excluding what is already in the cart
+        """
+        codes = [self.product_index[pid] for pid in product_ids if pid in self.product_index]
+        if not codes:
+            return []
+        summed = sp.csr_matrix(self.matrix[codes].sum(axis=0))
+        return self._top(summed.indices, summed.data, n, exclude=set(codes))
+
+    def get_stats(self):
+        return {
+            "n_products": len(self.product_ids),
+            "n_pairs": int(self.matrix.nnz),
+            "n_sessions": int(self.n_sessions),
+            "open_sessions": len(self.open_sessions),
+            "dropped_untimed": int(self.dropped_untimed),
+            "top_k": self.top_k,
+            "min_count": self.min_count,
+            "updated_at": self.updated_at,
+            "description": "Item-item co-occurrence over purchase/cart sessions"
+        }
+
+    def save_model(self, filepath):
+        """Save engine state to disk"""
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        with open(filepath, 'wb') as f:
+            pickle.dump({
+                'params': {
+                    'top_k': self.top_k,
+                    'min_count': self.min_count,
+                    'session_gap_ms': self.session_gap_ms,
+                    'slack': self.slack,
+                    'actions': self.actions
+                },
+                'product_ids': self.product_ids,
+                'matrix': self.matrix,
+                'open_sessions': self.open_sessions,
+                'n_sessions': self.n_sessions,
+                'dropped_untimed': self.dropped_untimed,
+                'updated_at': self.updated_at
+            }, f)
+
+    def load_model(self, filepath):
+        """Load engine state from disk"""
+        with open(filepath, 'rb') as f:
+            data = pickle.load(f)
+        params = data['params']
+        self.top_k = params['top_k']
+        self.min_count = params['min_count']
+        self.session_gap_ms = params['session_gap_ms']
+        self.slack = params['slack']
+        self.actions = tuple(params['actions'])
+        self.product_ids = data['product_ids']
+        self.product_index = {pid: i for i, pid in enumerate(self.product_ids)}
+        self.matrix = data['matrix']
+        self.open_sessions = data['open_sessions']
+        self.n_sessions = data['n_sessions']
+        self.dropped_untimed = data.get('dropped_untimed', 0)
+        self.updated_at = data['updated_at']
+        return self
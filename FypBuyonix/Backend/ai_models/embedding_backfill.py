@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Embedding Backfill Job for Buyonix Visual Search
+Recomputes image embeddings for the whole catalog (e.g. after a model
+upgrade) outside the API process.
+
+- Streams a JSONL manifest: one {productId, imageUrl | imageBase64, category?, price?, inStock?} per line
+- Fetches and decodes images in a thread pool while the previous batch runs inference
+- Runs batched MobileNetV2 inference
+- Writes embeddings in chunk files (embeddings-00000.npz ...) with ids, features,
+  perceptual hashes and the manifest attributes
+- Resumable: a rerun reads the ids already in the chunk files and skips them
+- Optional preprocessed-tensor store (--tensor-store): resized images are kept in a
+  memory-mapped array, entries already there skip download and decode, and
+  --from-tensor-store re-embeds the whole store without touching the manifest
+
+Usage:
+  python embedding_backfill.py manifest.jsonl output_dir [--batch-size 32] [--workers 8] [--chunk-size 1024]
+                               [--tensor-store DIR]
+  python embedding_backfill.py output_dir --from-tensor-store DIR [--batch-size 32] [--chunk-size 1024]
+  (use '-' as manifest to read from stdin)
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_hash import phash
+from tensor_store import ImageTensorStore
+
+CHUNK_PATTERN = 'embeddings-*.npz'
+FAILED_FILE = 'failed.jsonl'
+
+
+def iter_chunks(output_dir):
+    """Yield the arrays of every completed chunk file, in write order."""
+    for path in sorted(glob.glob(os.path.join(output_dir, CHUNK_PATTERN))):
+        with np.load(path) as chunk:
+            yield {key: chunk[key] for key in chunk.files}
+
+
+def completed_ids(output_dir):
+    """Product ids already embedded by a previous run."""
+    done = set()
+    for path in sorted(glob.glob(os.path.join(output_dir, CHUNK_PATTERN))):
+        with np.load(path) as chunk:
+            done.update(chunk['ids'].tolist())
+    return done
+
+
+def load_index_from_chunks(output_dir, visual_index, hash_index=None):
+    """Populate a VisualIndex (and optional HashIndex) from backfill output."""
+    count = 0
+    for chunk in iter_chunks(output_dir):
+        for i, product_id in enumerate(chunk['ids'].tolist()):
+            visual_index.upsert(
+                product_id,
+                chunk['features'][i],
+                category=chunk['categories'][i] or None,
+                price=None if np.isnan(chunk['prices'][i]) else float(chunk['prices'][i]),
+                in_stock=bool(chunk['in_stock'][i])
+            )
+            if hash_index is not None:
+                hash_index.add(product_id, int(chunk['hashes'][i]))
+            count += 1
+    return count
+
+
+def read_manifest(source):
+    """Stream manifest entries from a JSONL file (or stdin for '-')."""
+    stream = sys.stdin if source == '-' else open(source, 'r', encoding='utf-8')
+    try:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def count_pending(source, done_ids):
+    """Number of manifest entries still to embed (None for stdin, so no ETA)."""
+    if source == '-':
+        return None
+    return sum(1 for entry in read_manifest(source) if str(entry.get('productId')) not in done_ids)
+
+
+def batched(entries, batch_size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def image_source(entry):
+    return entry.get('imageUrl') or entry.get('imageBase64') or entry.get('image')
+
+
+def source_digest(entry):
+    """Short digest of an entry's image URL/data, to notice when a product's image changed."""
+    return hashlib.sha1((image_source(entry) or '').encode('utf-8')).hexdigest()
+
+
+def fetch_and_decode(entry):
+    """Download/decode one manifest entry into a resized uint8 array and its hash."""
+    # Imported here so the chunk helpers above stay usable without TensorFlow
+    from visual_search import load_image_from_base64, load_image_from_url, resize_image
+
+    source = image_source(entry)
+    if not source:
+        raise ValueError("No image in manifest entry")
+
+    if source.startswith('data:') or len(source) > 500:
+        img = load_image_from_base64(source)
+    else:
+        img = load_image_from_url(source)
+
+    return resize_image(img), phash(img)
+
+
+def next_chunk_number(output_dir):
+    """One past the highest existing chunk number, so gaps (deleted chunks) are never overwritten."""
+    numbers = [
+        int(os.path.basename(path)[len('embeddings-'):-len('.npz')])
+        for path in glob.glob(os.path.join(output_dir, CHUNK_PATTERN))
+    ]
+    return max(numbers) + 1 if numbers else 0
+
+
+class _Loaded:
+    """Future-like wrapper for an entry served from the tensor store."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def store_attributes(entry, image_hash):
+    """Manifest attributes kept next to a tensor, so re-embedding needs no manifest."""
+    return {
+        'category': entry.get('category'),
+        'price': entry.get('price'),
+        'inStock': entry.get('inStock', True),
+        'hash': int(image_hash),
+        'source': source_digest(entry)
+    }
+
+
+class ChunkWriter:
+    def __init__(self, output_dir, chunk_size, tensor_store=None):
+        """
+        Buffers embeddings and flushes them to numbered chunk files
+
+        Args:
+            tensor_store: Optional ImageTensorStore flushed before each chunk is
+                          committed, so no committed id is missing from the store
+        """
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.tensor_store = tensor_store
+        self.next_chunk = next_chunk_number(output_dir)
+        self._reset()
+
+    def _reset(self):
+        self.ids, self.features, self.hashes = [], [], []
+        self.categories, self.prices, self.in_stock = [], [], []
+
+    def add(self, entry, features, image_hash):
+        self.ids.append(str(entry['productId']))
+        self.features.append(features)
+        self.hashes.append(image_hash)
+        self.categories.append(str(entry.get('category') or ''))
+        price = entry.get('price')
+        self.prices.append(np.nan if price is None else float(price))
+        self.in_stock.append(bool(entry.get('inStock', True)))
+        if len(self.ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows atomically (tmp file + rename) so a crash never leaves half a chunk."""
+        if not self.ids:
+            return
+        path = os.path.join(self.output_dir, f'embeddings-{self.next_chunk:05d}.npz')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                ids=np.array(self.ids),
+                features=np.stack(self.features).astype(np.float32),
+                hashes=np.array(self.hashes, dtype=np.uint64),
+                categories=np.array(self.categories),
+                prices=np.array(self.prices, dtype=np.float32),
+                in_stock=np.array(self.in_stock, dtype=bool)
+            )
+        if self.tensor_store is not None:
+            self.tensor_store.flush()
+        os.replace(tmp_path, path)
+        self.next_chunk += 1
+        self._reset()
+
+
+def report_progress(done, failed, total, started):
+    """Throughput and ETA on stderr (stdout is reserved for the JSON summary)."""
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    if total is not None and rate > 0:
+        remaining = max(total - done - failed, 0) / rate
+        eta = f"ETA {int(remaining // 60)}m{int(remaining % 60):02d}s"
+        position = f"{done + failed}/{total}"
+    else:
+        eta = "ETA n/a"
+        position = f"{done + failed}"
+    print(f"  {position} processed, {failed} failed, {rate:.1f} img/s, {eta}", file=sys.stderr, flush=True)
+
+
+def run_backfill(manifest, output_dir, batch_size=32, workers=8, chunk_size=1024, tensor_store=None):
+    """
+    Embed every manifest entry not already present in output_dir
+
+    Args:
+        tensor_store: Optional tensor store directory; cached entries skip the
+                      download/decode and newly fetched ones are added to it
+
+    Returns:
+        Summary dict (processed, failed, skipped, elapsed seconds)
+    """
+    from visual_search import extract_features_batch
+
+    os.makedirs(output_dir, exist_ok=True)
+    done_ids = completed_ids(output_dir)
+    total = count_pending(manifest, done_ids)
+
+    skipped = 0
+
+    def pending():
+        nonlocal skipped
+        for entry in read_manifest(manifest):
+            if str(entry.get('productId')) in done_ids:
+                skipped += 1
+                continue
+            yield entry
+
+    store = ImageTensorStore(tensor_store) if tensor_store else None
+    writer = ChunkWriter(output_dir, chunk_size, tensor_store=store)
+    processed = failed = cached = 0
+    started = time.time()
+
+    def load(entry):
+        product_id = str(entry.get('productId'))
+        # A changed image URL/data means the stored tensor is stale: refetch it
+        if store is not None and product_id in store \
+                and store.attributes.get(product_id, {}).get('source') == source_digest(entry):
+            return _Loaded((store.get(product_id), store.attributes[product_id]['hash']))
+        return pool.submit(fetch_and_decode, entry)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+            open(os.path.join(output_dir, FAILED_FILE), 'a', encoding='utf-8') as failed_log:
+        batches = batched(pending(), batch_size)
+
+        def submit(batch):
+            return batch, [load(entry) for entry in batch]
+
+        # Keep one batch downloading while the current one runs inference
+        next_batch = next(batches, None)
+        in_flight = submit(next_batch) if next_batch else None
+
+        try:
+            while in_flight is not None:
+                batch, futures = in_flight
+                next_batch = next(batches, None)
+                in_flight = submit(next_batch) if next_batch else None
+
+                entries, arrays, hashes = [], [], []
+                for entry, future in zip(batch, futures):
+                    try:
+                        array, image_hash = future.result()
+                        if isinstance(future, _Loaded):
+                            cached += 1
+                        elif store is not None:
+                            store.put(str(entry['productId']), array, store_attributes(entry, image_hash))
+                        entries.append(entry)
+                        arrays.append(array)
+                        hashes.append(image_hash)
+                    except Exception as e:
+                        failed += 1
+                        failed_log.write(json.dumps({'productId': entry.get('productId'), 'error': str(e)}) + '\n')
+
+                if entries:
+                    features = extract_features_batch(np.stack(arrays), batch_size=batch_size)
+                    for entry, vector, image_hash in zip(entries, features, hashes):
+                        writer.add(entry, vector, image_hash)
+                    processed += len(entries)
+
+                report_progress(processed, failed, total, started)
+        finally:
+            # Keep whatever finished before an interrupt, the rerun picks up from there
+            writer.flush()
+            if store is not None:
+                store.flush()
+
+    return {
+        'processed': processed,
+        'failed': failed,
+        'skipped': skipped,
+        'fromTensorStore': cached,
+        'elapsedSeconds': round(time.time() - started, 2)
+    }
+
+
+def run_reembed(tensor_store, output_dir, batch_size=32, chunk_size=1024):
+    """
+    Embed every tensor in a store not already present in output_dir; reads the
+    memory-mapped array in storage order and feeds it straight to inference
+
+    Returns:
+        Summary dict (processed, skipped, elapsed seconds)
+    """
+    from visual_search import extract_features_batch
+
+    store = ImageTensorStore(tensor_store, readonly=True)
+    os.makedirs(output_dir, exist_ok=True)
+    done_ids = completed_ids(output_dir)
+    total = sum(1 for product_id in store.ids if product_id not in done_ids)
+
+    writer = ChunkWriter(output_dir, chunk_size)
+    processed = 0
+    started = time.time()
+
+    try:
+        for ids, tensors in store.iter_batches(batch_size, skip_ids=done_ids):
+            features = extract_features_batch(tensors, batch_size=batch_size)
+            for product_id, vector in zip(ids, features):
+                attributes = store.attributes.get(product_id, {})
+                writer.add({'productId': product_id, **attributes}, vector, attributes.get('hash', 0))
+            processed += len(ids)
+            report_progress(processed, 0, total, started)
+    finally:
+        writer.flush()
+
+    return {
+        'processed': processed,
+        'failed': 0,
+        'skipped': len(store) - total,
+        'elapsedSeconds': round(time.time() - started, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resumable batch embedding backfill')
+    parser.add_argument('manifest', nargs='?', help="JSONL manifest path, or '-' for stdin")
+    parser.add_argument('output_dir', help='Directory for embedding chunk files')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=8, help='Parallel image downloads/decodes')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='Embeddings per chunk file')
+    parser.add_argument('--tensor-store', help='Preprocessed-tensor store directory to read from and fill')
+    parser.add_argument('--from-tensor-store', help='Re-embed every tensor in this store (no manifest)')
+    args = parser.parse_args()
+
+    if not args.manifest and not args.from_tensor_store:
+        parser.error('a manifest is required unless --from-tensor-store is given')
+
+    try:
+        if args.from_tensor_store:
+            summary = run_reembed(args.from_tensor_store, args.output_dir, args.batch_size, args.chunk_size)
+        else:
+            summary = run_backfill(args.manifest, args.output_dir, args.batch_size, args.workers,
+                                   args.chunk_size, args.tensor_store)
+        print(json.dumps({"success": True, **summary}))
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
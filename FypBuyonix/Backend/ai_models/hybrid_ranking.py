@@ -0,0 +1,124 @@
+"""
+Hybrid Ranking for Buyonix - visual similarity + collaborative filtering
+Candidates come from the visual embedding index (what the shopper is looking
+at); they are then re-ranked by the shopper's CollaborativeFilteringModel
+score (what this user tends to like) in one vectorized pass.
+
+    score = visual_weight * similarity + cf_weight * cf_affinity
+
+cf_affinity is the candidates' predicted ratings min-max normalised over the
+candidate set, so both terms are on a 0..1 scale and the user's relative
+preference among these candidates is what moves them. Candidates the CF model
+has never seen get the mean CF score of the other candidates, so they are
+neither boosted nor buried; unknown users fall back to pure visual ranking.
+"""
+
+import numpy as np
+
+DEFAULT_VISUAL_WEIGHT = 0.7
+DEFAULT_CF_WEIGHT = 0.3
+
+
+def blend_scores(similarities, cf_ratings, visual_weight=DEFAULT_VISUAL_WEIGHT, cf_weight=DEFAULT_CF_WEIGHT):
+    """
+    Blend visual similarities with CF predicted ratings
+
+    Args:
+        similarities: Cosine similarities of the candidates
+        cf_ratings: Predicted ratings aligned with similarities, NaN if unknown
+                    (min-max normalised over the candidates before blending)
+        visual_weight / cf_weight: Blending weights (normalized to sum to 1)
+
+    Returns:
+        float array of blended scores
+    """
+    similarities = np.asarray(similarities, dtype=np.float64)
+    cf_ratings = np.asarray(cf_ratings, dtype=np.float64)
+
+    total = visual_weight + cf_weight
+    if total <= 0:
+        raise ValueError("Blending weights must sum to a positive value")
+    visual_weight, cf_weight = visual_weight / total, cf_weight / total
+
+    known = ~np.isnan(cf_ratings)
+    if not known.any():
+        return similarities.copy()
+
+    low, high = cf_ratings[known].min(), cf_ratings[known].max()
+    if high - low > 1e-12:
+        cf_scores = (cf_ratings - low) / (high - low)
+        cf_scores[~known] = cf_scores[known].mean()
+    else:
+        # No preference among these candidates: the CF term cannot reorder them
+        cf_scores = np.full(len(cf_ratings), 0.5)
+
+    return visual_weight * similarities + cf_weight * cf_scores
+
+
+class HybridRanker:
+    def __init__(self, visual_index, cf_model=None, visual_weight=DEFAULT_VISUAL_WEIGHT,
+                 cf_weight=DEFAULT_CF_WEIGHT, candidate_multiplier=5):
+        """
+        Args:
+            visual_index: VisualIndex providing candidates
+            cf_model: Trained CollaborativeFilteringModel (None = visual only)
+            visual_weight / cf_weight: Default blending weights
+            candidate_multiplier: Visual candidates fetched per requested result,
+                                  so CF re-ranking has room to reorder
+        """
+        self.visual_index = visual_index
+        self.cf_model = cf_model
+        self.visual_weight = visual_weight
+        self.cf_weight = cf_weight
+        self.candidate_multiplier = candidate_multiplier
+
+    def rank(self, query, user_id=None, top_k=10, visual_weight=None, cf_weight=None,
+             exclude=None, **filters):
+        """
+        Rank products for a query embedding and a user
+
+        Args:
+            query: Query feature vector
+            user_id: User whose CF affinity re-ranks the candidates
+            top_k: Number of results
+            visual_weight / cf_weight: Override the default blending weights
+            exclude: Optional productId to leave out (e.g. the query product)
+            **filters: Passed to VisualIndex.search (category, min_price, in_stock...)
+
+        Returns:
+            List of {productId, score, similarity, predictedRating} sorted by score
+        """
+        candidates = self.visual_index.search(
+            query,
+            top_k=top_k * self.candidate_multiplier,
+            exclude=exclude,
+            **filters
+        )
+        if not candidates:
+            return []
+
+        product_ids = [product_id for product_id, _ in candidates]
+        similarities = np.array([similarity for _, similarity in candidates])
+
+        if self.cf_model is not None and self.cf_model.is_trained and user_id is not None:
+            cf_ratings = self.cf_model.score_products(user_id, product_ids)
+        else:
+            cf_ratings = np.full(len(product_ids), np.nan)
+
+        scores = blend_scores(
+            similarities,
+            cf_ratings,
+            self.visual_weight if visual_weight is None else visual_weight,
+            self.cf_weight if cf_weight is None else cf_weight
+        )
+
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return [
+            {
+                'productId': product_ids[i],
+                'score': float(scores[i]),
+                'similarity': float(similarities[i]),
+                'predictedRating': None if np.isnan(cf_ratings[i]) else float(cf_ratings[i])
+            }
+            for i in order
+        ]
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Perceptual Hashing for Buyonix Visual Search
+Cheap 64-bit image fingerprints that catch exact and near-duplicate uploads
+(re-listed items, seller re-uploads, recompressed/resized copies) before any
+CNN inference is needed.
+
+- dHash: sign of horizontal gradients on a 9x8 grayscale thumbnail
+- pHash: sign of low-frequency DCT coefficients of a 32x32 thumbnail vs. median
+
+HashIndex answers Hamming-distance queries with multi-index hashing: the 64
+bits are split into (max_distance + 1) bands, so by the pigeonhole principle
+any hash within max_distance shares at least one band exactly with the query.
+Only the rows in those band buckets are compared.
+
+CLI (JSON on stdin, JSON on stdout, same as visual_search.py):
+  {"action": "report", "products": [{productId, imageUrl | imageBase64 | hash}], "maxDistance": 6}
+"""
+
+import io
+import sys
+import json
+import base64
+import threading
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 6
+
+# Bit count of every byte value, used for vectorized popcount over uint64 arrays
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis, so a 2D DCT is just M @ X @ M.T."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_int(bits):
+    """Pack a flat boolean array of 64 bits into an unsigned Python int."""
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), 'big')
+
+
+def _grayscale(img, size):
+    """Grayscale thumbnail as a float32 array of shape (height, width)."""
+    thumb = img.convert('L').resize(size, Image.Resampling.BILINEAR)
+    return np.asarray(thumb, dtype=np.float32)
+
+
+def dhash(img):
+    """64-bit difference hash of a PIL image."""
+    pixels = _grayscale(img, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(img):
+    """64-bit DCT perceptual hash of a PIL image."""
+    pixels = _grayscale(img, (32, 32))
+    coefficients = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].flatten()
+    # Skip the DC term when taking the median, it only encodes brightness
+    return _bits_to_int(coefficients > np.median(coefficients[1:]))
+
+
+def compute_hash(img, method='phash'):
+    """Compute the named perceptual hash ('phash' or 'dhash')."""
+    if method == 'phash':
+        return phash(img)
+    if method == 'dhash':
+        return dhash(img)
+    raise ValueError(f"Unknown hash method: {method}")
+
+
+def hash_to_hex(value):
+    """Format a 64-bit hash as a fixed-width hex string (JSON-safe)."""
+    return f"{value:016x}"
+
+
+def hex_to_hash(value):
+    """Parse a hex string produced by hash_to_hex."""
+    return int(value, 16)
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between two 64-bit hashes."""
+    return bin(a ^ b).count('1')
+
+
+def hamming_distances(query, hashes):
+    """Vectorized Hamming distance from one hash to a uint64 array of hashes."""
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(query))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex:
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        In-memory index of perceptual hashes keyed by productId.
+
+        Args:
+            max_distance: Largest Hamming distance lookups are guaranteed to find.
+                          Also sets the number of bands (max_distance + 1).
+        """
+        self.max_distance = max_distance
+        n_bands = max_distance + 1
+        edges = np.linspace(0, HASH_BITS, n_bands + 1).astype(int)
+        self._bands = [(int(lo), int(hi - lo)) for lo, hi in zip(edges[:-1], edges[1:])]
+        self._buckets = [{} for _ in self._bands]
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._ids = []
+        self._rows = {}
+        self._free_rows = []
+        # add/remove mutate the bucket lists that lookup iterates over
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _band_keys(self, value):
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in self._bands]
+
+    def add(self, product_id, value):
+        """Insert or replace the hash for a product."""
+        with self._lock:
+            self.remove(product_id)
+
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._ids)
+                self._ids.append(None)
+                if row >= len(self._hashes):
+                    grown = np.zeros(max(64, 2 * len(self._hashes)), dtype=np.uint64)
+                    grown[:len(self._hashes)] = self._hashes
+                    self._hashes = grown
+
+            self._hashes[row] = np.uint64(value)
+            self._ids[row] = product_id
+            self._rows[product_id] = row
+
+            for bucket, key in zip(self._buckets, self._band_keys(value)):
+                bucket.setdefault(key, []).append(row)
+
+    def remove(self, product_id):
+        """Drop a product from the index (no-op if absent)."""
+        with self._lock:
+            row = self._rows.pop(product_id, None)
+            if row is None:
+                return
+
+            for bucket, key in zip(self._buckets, self._band_keys(int(self._hashes[row]))):
+                rows = bucket.get(key)
+                if rows is not None:
+                    rows.remove(row)
+                    if not rows:
+                        del bucket[key]
+
+            self._ids[row] = None
+            self._free_rows.append(row)
+
+    def get(self, product_id):
+        """Stored hash for a product, or None."""
+        with self._lock:
+            row = self._rows.get(product_id)
+            return None if row is None else int(self._hashes[row])
+
+    def _candidate_rows(self, value):
+        rows = set()
+        for bucket, key in zip(self._buckets, self._band_keys(value)):
+            rows.update(bucket.get(key, ()))
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def lookup(self, value, max_distance=None, exclude=None):
+        """
+        Find indexed products within max_distance bits of a hash.
+
+        Args:
+            value: 64-bit query hash
+            max_distance: Defaults to (and is capped at) the index's max_distance
+            exclude: Optional productId to leave out (e.g. the query itself)
+
+        Returns:
+            List of (productId, distance) sorted by distance (ascending)
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        with self._lock:
+            rows = self._candidate_rows(value)
+            if len(rows) == 0:
+                return []
+
+            distances = hamming_distances(value, self._hashes[rows])
+            keep = distances <= max_distance
+            rows, distances = rows[keep], distances[keep]
+            order = np.argsort(distances, kind='stable')
+
+            return [
+                (self._ids[row], int(distance))
+                for row, distance in zip(rows[order], distances[order])
+                if self._ids[row] != exclude
+            ]
+
+    def items(self):
+        """Snapshot list of (productId, hash) pairs."""
+        with self._lock:
+            return [(product_id, int(self._hashes[row])) for product_id, row in self._rows.items()]
+
+
+def duplicate_report(index, max_distance=None):
+    """
+    Group every indexed product with its near-duplicates.
+
+    Near-duplicate pairs are found through the band buckets and merged with
+    union-find, so chains (A~B, B~C) end up in one group.
+
+    Returns:
+        List of {productIds, maxDistance} groups with 2+ members,
+        largest group first
+    """
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    group_distance = {}
+    for product_id, value in index.items():
+        for other_id, distance in index.lookup(value, max_distance, exclude=product_id):
+            root_a, root_b = find(product_id), find(other_id)
+            if root_a != root_b:
+                parent[root_b] = root_a
+                group_distance[root_a] = max(
+                    group_distance.pop(root_b, 0), group_distance.get(root_a, 0), distance
+                )
+            else:
+                group_distance[root_a] = max(group_distance.get(root_a, 0), distance)
+
+    groups = {}
+    for product_id, _ in index.items():
+        groups.setdefault(find(product_id), []).append(product_id)
+
+    report = [
+        {'productIds': members, 'maxDistance': int(group_distance.get(root, 0))}
+        for root, members in groups.items()
+        if len(members) > 1
+    ]
+    report.sort(key=lambda group: len(group['productIds']), reverse=True)
+    return report
+
+
+def load_image(source):
+    """Decode a data URL / base64 string or fetch a URL (PIL only, no TensorFlow)."""
+    if source.startswith('data:') or len(source) > 500:
+        image_data = base64.b64decode(source.split(',')[1] if ',' in source else source)
+    else:
+        import urllib.request
+        with urllib.request.urlopen(source, timeout=5) as response:
+            image_data = response.read()
+    img = Image.open(io.BytesIO(image_data))
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def main():
+    """Main entry point for CLI usage (batch duplicate report)."""
+    try:
+        data = json.loads(sys.stdin.read())
+        action = data.get('action', 'report')
+
+        if action != 'report':
+            print(json.dumps({"success": False, "error": f"Unknown action: {action}"}))
+            sys.exit(1)
+
+        max_distance = int(data.get('maxDistance', DEFAULT_MAX_DISTANCE))
+        method = data.get('method', 'phash')
+        index = HashIndex(max_distance=max_distance)
+        failed = []
+        missing_id = 0
+
+        for product in data.get('products', []):
+            product_id = product.get('productId')
+            if product_id is None:
+                # Would be reported as a null member of a duplicate group
+                missing_id += 1
+                continue
+            try:
+                if product.get('hash'):
+                    value = hex_to_hash(product['hash'])
+                else:
+                    img = load_image(product.get('imageUrl') or product.get('imageBase64'))
+                    value = compute_hash(img, method)
+                index.add(product_id, value)
+            except Exception:
+                failed.append(product_id)
+
+        groups = duplicate_report(index, max_distance)
+        print(json.dumps({
+            "success": True,
+            "method": method,
+            "indexed": len(index),
+            "failed": failed,
+            "missingProductId": missing_id,
+            "groups": groups,
+            "duplicateCount": sum(len(g['productIds']) - 1 for g in groups)
+        }))
+
+    except json.JSONDecodeError as e:
+        print(json.dumps({"success": False, "error": f"Invalid JSON input: {str(e)}"}))
+        sys.exit(1)
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Append-Only Columnar Interaction Log for Collaborative Filtering
+Keeps user-product interactions on disk so a retrain loads them in seconds
+instead of re-reading and JSON-encoding the whole history from MongoDB.
+
+- Segments: every appended batch becomes one compressed columnar file
+  (segment-000000.npz) with user/product int32 codes, action int8, weight and
+  rating float32 and timestamp int64 (epoch ms) columns
+- Dictionary: users.txt / products.txt hold one id per line; the line number is
+  the code. manifest.json is written last (atomically) and records how many
+  ids and which segments are committed, so a crash mid-append is rolled back
+- Compaction: once compact_after segments pile up they are folded into a base
+  directory of uncompressed .npy columns, with duplicate (user, product) rows
+  aggregated per time bucket (weights summed, latest rating and timestamp kept)
+- Loading: the base is memory-mapped, segments outside the requested time
+  window are skipped from the manifest, and the rest is reduced to one sparse
+  user x product rating matrix
+
+Single writer: append()/compact() must not run from two processes at once.
+"""
+
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from cooccurrence import to_millis
+
+# Action codes follow the Interaction schema enum (models/interaction.js)
+ACTIONS = ('view', 'cart', 'save', 'purchase')
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+COLUMNS = {
+    'user': np.int32,
+    'product': np.int32,
+    'action': np.int8,
+    'weight': np.float32,
+    'rating': np.float32,
+    'timestamp': np.int64
+}
+
+DAY_MS = 24 * 60 * 60 * 1000
+MANIFEST_FILE = 'manifest.json'
+
+
+def _empty_columns():
+    return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def aggregate(columns, bucket_ms=None):
+    """
+    Collapse rows sharing (user, product) -- and the same time bucket, if given
+
+    Args:
+        columns: Dict of column arrays (see COLUMNS)
+        bucket_ms: Bucket width in ms; None aggregates each pair over all time
+
+    Returns:
+        Dict of column arrays with one row per group: summed weight, strongest
+        action, latest explicit rating (NaN if none) and latest timestamp
+    """
+    n = len(columns['user'])
+    if n == 0:
+        return _empty_columns()
+
+    timestamps = columns['timestamp']
+    bucket = timestamps // bucket_ms if bucket_ms else np.zeros(n, dtype=np.int64)
+    order = np.lexsort((timestamps, bucket, columns['product'], columns['user']))
+
+    user = columns['user'][order]
+    product = columns['product'][order]
+    bucket = bucket[order]
+    rating = columns['rating'][order]
+
+    boundary = (user[1:] != user[:-1]) | (product[1:] != product[:-1]) | (bucket[1:] != bucket[:-1])
+    starts = np.flatnonzero(np.r_[True, boundary])
+
+    # Rows are time-ordered inside a group, so the largest rated position is the latest rating
+    rated_at = np.where(np.isnan(rating), -1, np.arange(n))
+    last_rated = np.maximum.reduceat(rated_at, starts)
+
+    return {
+        'user': user[starts],
+        'product': product[starts],
+        'action': np.maximum.reduceat(columns['action'][order], starts),
+        'weight': np.add.reduceat(columns['weight'][order], starts).astype(np.float32),
+        'rating': np.where(last_rated >= 0, rating[np.maximum(last_rated, 0)], np.nan).astype(np.float32),
+        'timestamp': np.maximum.reduceat(timestamps[order], starts)
+    }
+
+
+class InteractionLog:
+    def __init__(self, directory=None, compact_after=16, bucket_days=1):
+        """
+        Open (or create) an interaction log
+
+        Args:
+            directory: Log directory (default: interaction_log/ next to this file)
+            compact_after: Uncompacted segments that trigger a compaction on append
+            bucket_days: Time resolution kept by compaction (and so by windowed loads)
+        """
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'interaction_log')
+        self.compact_after = compact_after
+        self.bucket_ms = int(bucket_days * DAY_MS)
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'nUsers': 0, 'nProducts': 0, 'nextSegment': 0, 'segments': [], 'base': None}
+
+        self.user_ids = self._read_ids('users.txt', self.manifest['nUsers'])
+        self.product_ids = self._read_ids('products.txt', self.manifest['nProducts'])
+        self.user_index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        self.product_index = {product_id: i for i, product_id in enumerate(self.product_ids)}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_ids(self, name, count):
+        """Committed ids of a dictionary file; lines past the manifest count are dropped."""
+        path = self._path(name)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            ids = f.read().split('\n')
+        if len(ids) - 1 != count:
+            # Left over from an append that never reached the manifest
+            ids = ids[:count]
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(''.join(i + '\n' for i in ids))
+        return ids[:count]
+
+    def _encode(self, ids, table, index):
+        """Codes for ids, appending unseen ones to the in-memory dictionary."""
+        codes = np.empty(len(ids), dtype=np.int32)
+        for i, item in enumerate(ids):
+            code = index.get(item)
+            if code is None:
+                code = len(table)
+                index[item] = code
+                table.append(item)
+            codes[i] = code
+        return codes
+
+    def _write_manifest(self):
+        tmp_path = self._path(MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self._path(MANIFEST_FILE))
+
+    def _append_ids(self, name, ids):
+        if not ids:
+            return
+        with open(self._path(name), 'a', encoding='utf-8') as f:
+            f.write(''.join(i + '\n' for i in ids))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, interactions):
+        """
+        Append a batch of interactions as one segment
+
+        Args:
+            interactions: List of {userId, productId, action, weight?, rating?, timestamp?}
+                          dicts (or a DataFrame with those columns)
+
+        Returns:
+            Number of rows written
+        """
+        df = pd.DataFrame(interactions)
+        if df.empty:
+            return 0
+
+        n_users, n_products = len(self.user_ids), len(self.product_ids)
+        now_ms = int(time.time() * 1000)
+        columns = {
+            'user': self._encode(df['userId'].astype(str).tolist(), self.user_ids, self.user_index),
+            'product': self._encode(df['productId'].astype(str).tolist(), self.product_ids, self.product_index),
+            'action': df['action'].map(ACTION_CODES).fillna(-1).to_numpy(dtype=np.int8)
+                      if 'action' in df else np.full(len(df), -1, dtype=np.int8),
+            'weight': pd.to_numeric(df['weight'], errors='coerce').fillna(1).to_numpy(dtype=np.float32)
+                      if 'weight' in df else np.ones(len(df), dtype=np.float32),
+            'rating': pd.to_numeric(df['rating'], errors='coerce').to_numpy(dtype=np.float32)
+                      if 'rating' in df else np.full(len(df), np.nan, dtype=np.float32),
+            'timestamp': to_millis(df['timestamp'].fillna(now_ms))
+                         if 'timestamp' in df else np.full(len(df), now_ms, dtype=np.int64)
+        }
+
+        name = f"segment-{self.manifest['nextSegment']:06d}.npz"
+        tmp_path = self._path(name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(tmp_path, self._path(name))
+
+        self._append_ids('users.txt', self.user_ids[n_users:])
+        self._append_ids('products.txt', self.product_ids[n_products:])
+
+        self.manifest['segments'].append({
+            'file': name,
+            'rows': len(df),
+            'minTs': int(columns['timestamp'].min()),
+            'maxTs': int(columns['timestamp'].max())
+        })
+        self.manifest['nextSegment'] += 1
+        self.manifest['nUsers'] = len(self.user_ids)
+        self.manifest['nProducts'] = len(self.product_ids)
+        self._write_manifest()
+
+        if len(self.manifest['segments']) >= self.compact_after:
+            self.compact()
+        return len(df)
+
+    def _load_base(self):
+        base = self.manifest['base']
+        if base is None:
+            return None
+        directory = self._path(base['dir'])
+        return {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in COLUMNS}
+
+    def _load_segment(self, segment):
+        with np.load(self._path(segment['file'])) as data:
+            return {name: data[name] for name in COLUMNS}
+
+    def _iter_parts(self, since=None, until=None):
+        """Column dicts of the base and every segment overlapping [since, until] (epoch ms)."""
+        parts = []
+        if self.manifest['base'] is not None:
+            parts.append((self.manifest['base'], self._load_base))
+        for segment in self.manifest['segments']:
+            parts.append((segment, lambda segment=segment: self._load_segment(segment)))
+
+        for meta, load in parts:
+            if since is not None and meta['maxTs'] < since:
+                continue
+            if until is not None and meta['minTs'] > until:
+                continue
+            columns = load()
+            if since is None and until is None:
+                yield columns
+                continue
+            timestamps = np.asarray(columns['timestamp'])
+            mask = np.ones(len(timestamps), dtype=bool)
+            if since is not None:
+                mask &= timestamps >= since
+            if until is not None:
+                mask &= timestamps <= until
+            yield {name: np.asarray(column)[mask] for name, column in columns.items()}
+
+    def _read(self, since=None, until=None):
+        parts = list(self._iter_parts(since, until))
+        if not parts:
+            return _empty_columns()
+        return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+    def compact(self):
+        """
+        Fold the base and all segments into a new base of aggregated, uncompressed
+        .npy columns, then drop the old files
+
+        Returns:
+            Rows in the new base
+        """
+        if not self.manifest['segments']:
+            return self.manifest['base']['rows'] if self.manifest['base'] else 0
+
+        columns = aggregate(self._read(), self.bucket_ms)
+        name = f"base-{self.manifest['nextSegment']:06d}"
+        tmp_dir = self._path(name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), values)
+        os.replace(tmp_dir, self._path(name))
+
+        old_base, old_segments = self.manifest['base'], self.manifest['segments']
+        self.manifest['base'] = {
+            'dir': name,
+            'rows': len(columns['user']),
+            'minTs': int(columns['timestamp'].min()) if len(columns['user']) else 0,
+            'maxTs': int(columns['timestamp'].max()) if len(columns['user']) else 0
+        }
+        self.manifest['segments'] = []
+        self.manifest['nextSegment'] += 1
+        self._write_manifest()
+
+        if old_base is not None:
+            shutil.rmtree(self._path(old_base['dir']), ignore_errors=True)
+        for segment in old_segments:
+            os.remove(self._path(segment['file']))
+        return self.manifest['base']['rows']
+
+    def load_matrix(self, since=None, until=None, rating='last'):
+        """
+        Sparse user x product rating matrix, optionally for a time window
+
+        Args:
+            since: Only interactions at or after this epoch-ms timestamp
+            until: Only interactions at or before this epoch-ms timestamp
+            rating: How a pair's interactions become one rating
+                    'last' - its latest interaction: the explicit rating, otherwise
+                             min(weight / 2, 5). This is what train() gets from
+                             cfRecommender.js (rating || weight rule per interaction,
+                             then the last one per pair), so both paths train alike.
+                             Compacted history only has one row per pair and time
+                             bucket, so there the latest bucket stands in for the
+                             latest interaction
+                    'sum'  - its latest explicit rating, otherwise
+                             min(summed weight / 2, 5)
+
+        Returns:
+            (scipy.sparse.csr_matrix float32, user_ids, product_ids) limited to
+            the users and products present in the window
+        """
+        columns = self._read(since, until)
+        if rating == 'last':
+            n = len(columns['user'])
+            # Parts are read base first, then segments in append order, so the
+            # position breaks timestamp ties in favour of the later append
+            order = np.lexsort((np.arange(n), columns['timestamp'], columns['product'], columns['user']))
+            user, product = columns['user'][order], columns['product'][order]
+            last = np.flatnonzero(np.r_[(user[1:] != user[:-1]) | (product[1:] != product[:-1]), n > 0])
+            pairs = {name: columns[name][order][last] for name in ('user', 'product', 'weight', 'rating')}
+        elif rating == 'sum':
+            pairs = aggregate(columns)
+        else:
+            raise ValueError(f"Unknown rating rule: {rating}")
+        ratings = np.where(np.isnan(pairs['rating']), np.minimum(pairs['weight'] / 2, 5), pairs['rating'])
+
+        users, rows = np.unique(pairs['user'], return_inverse=True)
+        products, cols = np.unique(pairs['product'], return_inverse=True)
+        matrix = sp.csr_matrix(
+            (ratings.astype(np.float32), (rows, cols)),
+            shape=(len(users), len(products))
+        )
+        return (
+            matrix,
+            [self.user_ids[code] for code in users],
+            [self.product_ids[code] for code in products]
+        )
+
+    def load_ratings(self, since=None, until=None, rating='last'):
+        """The load_matrix ratings as a (user_id, product_id, rating) DataFrame for model.train()."""
+        matrix, user_ids, product_ids = self.load_matrix(since, until, rating)
+        coo = matrix.tocoo()
+        return pd.DataFrame({
+            'user_id': np.array(user_ids, dtype=object)[coo.row],
+            'product_id': np.array(product_ids, dtype=object)[coo.col],
+            'rating': coo.data
+        })
+
+    def get_stats(self):
+        base = self.manifest['base']
+        segments = self.manifest['segments']
+        timestamps = [s['minTs'] for s in segments] + ([base['minTs']] if base and base['rows'] else [])
+        latest = [s['maxTs'] for s in segments] + ([base['maxTs']] if base and base['rows'] else [])
+        return {
+            'n_users': len(self.user_ids),
+            'n_products': len(self.product_ids),
+            'base_rows': base['rows'] if base else 0,
+            'segments': len(segments),
+            'segment_rows': sum(s['rows'] for s in segments),
+            'oldest_ms': min(timestamps) if timestamps else None,
+            'newest_ms': max(latest) if latest else None,
+            'description': 'Append-only columnar interaction log'
+        }
@@ -1,16 +1,24 @@
 from fastapi import FastAPI, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-import pickle
+import os
+from typing import Optional
+from cf_model_registry import ModelRegistry
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-cf_model = None
+# One or more CF model versions; users are routed to a version by hash of user_id
+CF_REGISTRY_PATH = os.environ.get("CF_REGISTRY_PATH", "cf_registry.json")
+cf_registry = None
 try:
-    with open("cf_model.pkl", "rb") as f:
-        cf_model = pickle.load(f)
-    print("CF Model loaded")
+    if os.path.exists(CF_REGISTRY_PATH):
+        cf_registry = ModelRegistry.from_config(CF_REGISTRY_PATH)
+    else:
+        cf_registry = ModelRegistry()
+        cf_registry.register("default", "cf_model.pkl")
+    print(f"CF Model loaded ({', '.join(cf_registry.versions)})")
 except Exception as e:
+    cf_registry = None
     print(f"CF Model not loaded: {e}")
 
 @app.get("/")
@@ -19,17 +27,39 @@ def root():
 
 @app.get("/health")
 def health():
-    return {"status": "healthy", "cf_model": cf_model is not None}
+    return {"status": "healthy", "cf_model": cf_registry is not None}
 
 @app.get("/recommendations/{user_id}")
-def get_recommendations(user_id: str, limit: int = 10):
+def get_recommendations(user_id: str, limit: int = 10, in_stock: bool = False, category: Optional[str] = None,
+                        min_price: Optional[float] = None, max_price: Optional[float] = None):
     try:
-        if cf_model is None:
+        if cf_registry is None:
             return {"recommendations": [], "message": "Model not loaded"}
-        return {"recommendations": [], "userId": user_id}
+        filters = {
+            "in_stock": in_stock,
+            "seller_active": True,
+            "categories": [category] if category else None,
+            "min_price": min_price,
+            "max_price": max_price
+        }
+        version, recommendations = cf_registry.recommend(user_id, limit, filters=filters)
+        return {
+            "recommendations": [
+                {"product_id": pid, "predicted_rating": float(rating)}
+                for pid, rating in recommendations
+            ],
+            "userId": user_id,
+            "modelVersion": version
+        }
     except Exception as e:
         return {"recommendations": [], "error": str(e)}
 
+@app.get("/recommendations-stats")
+def recommendation_stats():
+    if cf_registry is None:
+        return {"versions": {}, "message": "Model not loaded"}
+    return {"versions": cf_registry.get_stats(), "sharing": cf_registry.shared_memory_report()}
+
 @app.post("/visual-search")
 async def visual_search(file: UploadFile = File(...)):
     try:
@@ -0,0 +1,231 @@
+"""
+Per-Stage Request Tracing for Buyonix Visual Search
+Answers "which stage made this request slow?" for the visual search server.
+
+- trace_stage('predict') times a block into the request's trace; it is a no-op
+  when no trace is active, so visual_search.py can be instrumented safely
+- Each trace becomes a Server-Timing header and feeds per-(endpoint, stage)
+  latency histograms, exposed in Prometheus text or JSON
+- SamplingProfiler optionally runs cProfile on a sample of requests and keeps
+  the last N captures for a merged pstats dump
+"""
+
+import io
+import time
+import random
+import marshal
+import pstats
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds (+Inf is implicit)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_local = threading.local()
+
+
+class RequestTrace:
+    def __init__(self, endpoint):
+        """Stage durations (seconds) for one request, in first-seen order."""
+        self.endpoint = endpoint
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.total = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        return self.total
+
+    def server_timing(self):
+        """Server-Timing header value, durations in milliseconds."""
+        entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items()]
+        if self.total is not None:
+            entries.append(f"total;dur={self.total * 1000:.2f}")
+        return ', '.join(entries)
+
+
+def start_trace(endpoint):
+    """Begin tracing the current thread's request."""
+    _local.trace = RequestTrace(endpoint)
+    return _local.trace
+
+
+def end_trace():
+    """Stop tracing the current thread's request and return its trace (or None)."""
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+@contextmanager
+def trace_stage(stage):
+    """Time a block into the active trace; does nothing outside a traced request."""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - started)
+
+
+class StageHistograms:
+    def __init__(self, buckets=BUCKETS):
+        """Cumulative latency histograms keyed by (endpoint, stage)."""
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def observe(self, endpoint, stage, seconds):
+        with self._lock:
+            entry = self._data.get((endpoint, stage))
+            if entry is None:
+                entry = self._data[(endpoint, stage)] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0
+                }
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            entry['counts'][index] += 1
+            entry['sum'] += seconds
+            entry['count'] += 1
+
+    def record(self, trace):
+        """Add every stage of a finished trace, plus its total."""
+        for stage, seconds in trace.stages.items():
+            self.observe(trace.endpoint, stage, seconds)
+        if trace.total is not None:
+            self.observe(trace.endpoint, 'total', trace.total)
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: {'counts': list(v['counts']), 'sum': v['sum'], 'count': v['count']}
+                    for key, v in self._data.items()}
+
+    def to_json(self):
+        """{endpoint: {stage: {count, meanMs, buckets: {le: cumulative count}}}}"""
+        result = {}
+        for (endpoint, stage), entry in sorted(self._snapshot().items()):
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(list(self.buckets) + ['+Inf'], entry['counts']):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result.setdefault(endpoint, {})[stage] = {
+                'count': entry['count'],
+                'meanMs': round(entry['sum'] / entry['count'] * 1000, 3) if entry['count'] else 0.0,
+                'buckets': buckets
+            }
+        return result
+
+    def to_prometheus(self, name='visual_search_stage_seconds'):
+        """Prometheus text exposition format."""
+        lines = [
+            f'# HELP {name} Visual search request stage latency',
+            f'# TYPE {name} histogram'
+        ]
+        for (endpoint, stage), entry in sorted(self._snapshot().items()):
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], entry['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {entry["sum"]:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {entry["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    def __init__(self, capacity=20, sample_rate=1.0, enabled=False):
+        """
+        Opt-in cProfile capture of a sample of requests
+
+        Args:
+            capacity: Number of most recent captures kept
+            sample_rate: Fraction of requests profiled while enabled
+            enabled: Start profiling immediately
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._captures = deque(maxlen=capacity)
+        # Only one cProfile can be active at a time on newer Pythons
+        self._busy = threading.Lock()
+
+    def configure(self, enabled=None, sample_rate=None, capacity=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if capacity is not None:
+            self._captures = deque(self._captures, maxlen=capacity)
+
+    def start(self):
+        """Start profiling this request if sampled; returns a token for stop()."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            self._busy.release()
+            return None
+        return profile
+
+    def stop(self, profile, label=None):
+        if profile is None:
+            return
+        profile.disable()
+        self._busy.release()
+        profile.create_stats()
+        self._captures.append((label, profile.stats))
+
+    def __len__(self):
+        return len(self._captures)
+
+    def _merged(self):
+        captures = list(self._captures)
+        if not captures:
+            return None
+        stats = pstats.Stats(_StatsHolder(dict(captures[0][1])))
+        for _, raw in captures[1:]:
+            stats.add(_StatsHolder(raw))
+        return stats
+
+    def dump_text(self, sort='cumulative', limit=60):
+        """Merged pstats report of the kept captures."""
+        stats = self._merged()
+        if stats is None:
+            return 'No profiles captured (enable with POST /debug/profile?enabled=1)\n'
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def dump_binary(self):
+        """Merged capture in .prof format (snakeviz, flameprof, gprof2dot...)."""
+        stats = self._merged()
+        return None if stats is None else marshal.dumps(stats.stats)
+
+    def clear(self):
+        self._captures.clear()
+
+
+class _StatsHolder:
+    """Minimal object pstats.Stats accepts as a profile source (it calls create_stats())."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
@@ -0,0 +1,169 @@
+"""
+Preprocessed Image Tensor Store for Buyonix Visual Search
+Keeps every catalog image decoded and resized to 224x224 RGB uint8 in one
+memory-mapped array file, so re-embedding the catalog after a model change
+(new backbone, quantization...) reads that file and goes straight to batched
+inference: no downloads, no JPEG decode, no resize.
+
+Layout of a store directory:
+  tensors.u8   raw uint8 array of shape (capacity, 224, 224, 3), grown by doubling
+  index.json   {"shape": [224, 224, 3], "count": N, "ids": [...], "attributes": {id: {...}}}
+
+Row i of tensors.u8 belongs to ids[i]. index.json is rewritten atomically on
+flush(), so a crash can at worst lose rows appended since the last flush.
+"""
+
+import os
+import json
+import threading
+
+import numpy as np
+
+TENSOR_FILE = 'tensors.u8'
+INDEX_FILE = 'index.json'
+DEFAULT_SHAPE = (224, 224, 3)
+
+
+class ImageTensorStore:
+    def __init__(self, directory, shape=DEFAULT_SHAPE, readonly=False):
+        """
+        Open (or create) a tensor store
+
+        Args:
+            directory: Store directory
+            shape: Per-image tensor shape (fixed for the store's lifetime)
+            readonly: Open without write access (safe for concurrent readers)
+        """
+        self.directory = directory
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._tensor_path = os.path.join(directory, TENSOR_FILE)
+        self._index_path = os.path.join(directory, INDEX_FILE)
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            self.shape = tuple(index['shape'])
+            self.ids = index['ids'][:index['count']]
+            self.attributes = index.get('attributes', {})
+        else:
+            if readonly:
+                raise FileNotFoundError(f"No tensor store at {directory}")
+            os.makedirs(directory, exist_ok=True)
+            self.shape = tuple(shape)
+            self.ids = []
+            self.attributes = {}
+
+        self.rows = {product_id: i for i, product_id in enumerate(self.ids)}
+        self._item_bytes = int(np.prod(self.shape))
+        self._array = None
+        self._open_array()
+
+    def _capacity_on_disk(self):
+        if not os.path.exists(self._tensor_path):
+            return 0
+        return os.path.getsize(self._tensor_path) // self._item_bytes
+
+    def _open_array(self, capacity=None):
+        """(Re)map the tensor file, growing it to `capacity` rows if given."""
+        if self._array is not None:
+            if not self.readonly:
+                self._array.flush()
+            self._array = None
+
+        if capacity is not None:
+            with open(self._tensor_path, 'ab') as f:
+                f.truncate(capacity * self._item_bytes)
+
+        rows = self._capacity_on_disk()
+        if rows == 0:
+            return
+        self._array = np.memmap(
+            self._tensor_path,
+            dtype=np.uint8,
+            mode='r' if self.readonly else 'r+',
+            shape=(rows,) + self.shape
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, product_id):
+        return product_id in self.rows
+
+    def put(self, product_id, tensor, attributes=None):
+        """
+        Store (or overwrite) one image tensor
+
+        Args:
+            product_id: Product identifier
+            tensor: uint8 array of the store's shape (e.g. visual_search.resize_image output)
+            attributes: Optional small JSON-safe dict kept with the id (category, price...)
+        """
+        if self.readonly:
+            raise ValueError("Tensor store is read-only")
+        tensor = np.asarray(tensor, dtype=np.uint8)
+        if tensor.shape != self.shape:
+            raise ValueError(f"Tensor has shape {tensor.shape}, expected {self.shape}")
+
+        with self._lock:
+            row = self.rows.get(product_id)
+            if row is None:
+                row = len(self.ids)
+                capacity = 0 if self._array is None else self._array.shape[0]
+                if row >= capacity:
+                    self._open_array(max(256, 2 * capacity))
+                self.ids.append(product_id)
+                self.rows[product_id] = row
+            self._array[row] = tensor
+            if attributes is not None:
+                self.attributes[product_id] = attributes
+
+    def get(self, product_id):
+        """Copy of a stored tensor, or None."""
+        with self._lock:
+            row = self.rows.get(product_id)
+            return None if row is None else np.array(self._array[row])
+
+    def iter_batches(self, batch_size=64, skip_ids=None):
+        """
+        Yield (ids, tensors) in storage order; contiguous runs are sliced
+        straight from the memory map, so reads are sequential
+
+        Args:
+            batch_size: Rows per batch
+            skip_ids: Optional set of ids to leave out (e.g. already embedded)
+        """
+        count = len(self.ids)
+        for start in range(0, count, batch_size):
+            end = min(start + batch_size, count)
+            ids = self.ids[start:end]
+            if skip_ids:
+                keep = [i for i, product_id in enumerate(ids) if product_id not in skip_ids]
+                if not keep:
+                    continue
+                if len(keep) < len(ids):
+                    yield [ids[i] for i in keep], self._array[start:end][keep]
+                    continue
+            yield ids, self._array[start:end]
+
+    def flush(self):
+        """Persist tensor pages and rewrite the id index atomically."""
+        if self.readonly:
+            return
+        with self._lock:
+            if self._array is not None:
+                self._array.flush()
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'shape': list(self.shape),
+                    'count': len(self.ids),
+                    'ids': self.ids,
+                    'attributes': self.attributes
+                }, f)
+            os.replace(tmp_path, self._index_path)
+
+    def close(self):
+        self.flush()
+        self._array = None
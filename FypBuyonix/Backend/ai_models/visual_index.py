@@ -0,0 +1,267 @@
+"""
+Partitioned Visual Embedding Index for Buyonix Visual Search
+Keeps product embeddings in memory (L2-normalized float32) together with
+per-product attribute arrays, so a search scoped to a category only touches
+that partition's vectors instead of ranking the whole catalog and throwing
+most of it away.
+
+- Partition attributes (category, brand, sellerId...) are dictionary-encoded
+  into int32 codes; each value maps to a sorted array of row numbers
+- Price and stock filters are applied as vectorized boolean masks on the
+  candidate rows before the similarity matmul and top-K selection
+- Safe to share between the threaded server's request handlers: writes,
+  searches and the lazy partition cache all run under one RLock
+"""
+
+import threading
+
+import numpy as np
+
+MISSING_CODE = -1
+
+
+def normalize_attribute(value):
+    """Attribute values are matched case/whitespace-insensitively, like routes/product.js."""
+    if value is None:
+        return None
+    return str(value).lower().strip()
+
+
+class VisualIndex:
+    def __init__(self, dim=1280):
+        """
+        Initialize an empty index
+
+        Args:
+            dim: Embedding dimension (1280 for MobileNetV2 with avg pooling)
+        """
+        self.dim = dim
+        self._embeddings = np.zeros((0, dim), dtype=np.float32)
+        self._price = np.zeros(0, dtype=np.float32)
+        self._in_stock = np.zeros(0, dtype=bool)
+        self._valid = np.zeros(0, dtype=bool)
+        self._codes = {}        # attribute -> int32 code per row
+        self._vocab = {}        # attribute -> {value: code}
+        self._partitions = {}   # attribute -> {code: sorted row array}, rebuilt lazily
+        self._ids = []
+        self._rows = {}
+        self._free_rows = []
+        self._size = 0
+        # Writers and the lazily built partition cache share this lock with readers
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, product_id):
+        return product_id in self._rows
+
+    def _grow(self, capacity):
+        """Resize every per-row array to the new capacity."""
+        def grown(array, fill):
+            out = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            out[:len(array)] = array
+            return out
+
+        self._embeddings = grown(self._embeddings, 0)
+        self._price = grown(self._price, np.nan)
+        self._in_stock = grown(self._in_stock, False)
+        self._valid = grown(self._valid, False)
+        for name in self._codes:
+            self._codes[name] = grown(self._codes[name], MISSING_CODE)
+
+    def _allocate_row(self):
+        if self._free_rows:
+            return self._free_rows.pop()
+        row = self._size
+        self._size += 1
+        self._ids.append(None)
+        if row >= len(self._valid):
+            self._grow(max(256, 2 * len(self._valid)))
+        return row
+
+    def _encode(self, name, value):
+        if name not in self._codes:
+            self._codes[name] = np.full(len(self._valid), MISSING_CODE, dtype=np.int32)
+            self._vocab[name] = {}
+        value = normalize_attribute(value)
+        if value is None:
+            return MISSING_CODE
+        vocab = self._vocab[name]
+        if value not in vocab:
+            vocab[value] = len(vocab)
+        return vocab[value]
+
+    def upsert(self, product_id, embedding, category=None, price=None, in_stock=True, attributes=None):
+        """
+        Insert or replace one product
+
+        Args:
+            product_id: Product identifier
+            embedding: Feature vector (any float sequence of length dim)
+            category: Partition key used by category-scoped searches
+            price: Optional price (NaN when unknown; excluded by price filters)
+            in_stock: Stock flag used by in_stock filters
+            attributes: Optional {name: value} of extra partition attributes
+        """
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Embedding has dimension {vector.shape[0]}, expected {self.dim}")
+
+        with self._lock:
+            row = self._rows.get(product_id)
+            if row is None:
+                row = self._allocate_row()
+                self._rows[product_id] = row
+                self._ids[row] = product_id
+
+            norm = np.linalg.norm(vector)
+            self._embeddings[row] = vector / norm if norm > 0 else vector
+            self._price[row] = np.nan if price is None else price
+            self._in_stock[row] = bool(in_stock)
+            self._valid[row] = True
+
+            values = dict(attributes or {})
+            values['category'] = category
+            for name in set(values) | set(self._codes):
+                code = self._encode(name, values.get(name))
+                self._codes[name][row] = code
+
+            self._partitions.clear()
+
+    def remove(self, product_id):
+        """Drop a product from the index (no-op if absent)."""
+        with self._lock:
+            row = self._rows.pop(product_id, None)
+            if row is None:
+                return
+            self._valid[row] = False
+            self._ids[row] = None
+            for codes in self._codes.values():
+                codes[row] = MISSING_CODE
+            self._free_rows.append(row)
+            self._partitions.clear()
+
+    def update_attributes(self, product_id, price=None, in_stock=None):
+        """Update price/stock in place (does not invalidate partitions)."""
+        with self._lock:
+            row = self._rows.get(product_id)
+            if row is None:
+                return False
+            if price is not None:
+                self._price[row] = price
+            if in_stock is not None:
+                self._in_stock[row] = bool(in_stock)
+            return True
+
+    def _partition(self, name):
+        """{code: sorted rows} for one attribute, built with a single argsort."""
+        with self._lock:
+            if name not in self._partitions:
+                codes = self._codes[name][:self._size]
+                rows = np.flatnonzero(codes != MISSING_CODE)
+                rows = rows[np.argsort(codes[rows], kind='stable')]
+                boundaries = np.flatnonzero(np.diff(codes[rows])) + 1
+                self._partitions[name] = {
+                    int(codes[group[0]]): group
+                    for group in np.split(rows, boundaries)
+                    if len(group)
+                }
+            return self._partitions[name]
+
+    def _candidate_rows(self, filters):
+        """Rows matching every partition filter, or all rows when unscoped."""
+        rows = None
+        for name, value in filters.items():
+            value = normalize_attribute(value)
+            if value is None:
+                continue
+            code = self._vocab.get(name, {}).get(value)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            group = self._partition(name).get(code, np.zeros(0, dtype=np.int64))
+            rows = group if rows is None else np.intersect1d(rows, group, assume_unique=True)
+        if rows is None:
+            rows = np.arange(self._size)
+        return rows
+
+    def _filter_rows(self, rows, min_price=None, max_price=None, in_stock=None):
+        """Valid rows passing the price/stock filters."""
+        mask = self._valid[rows]
+        if min_price is not None:
+            mask &= self._price[rows] >= min_price
+        if max_price is not None:
+            mask &= self._price[rows] <= max_price
+        if in_stock:
+            mask &= self._in_stock[rows]
+        return rows[mask]
+
+    def matching(self, product_ids, category=None, attributes=None,
+                 min_price=None, max_price=None, in_stock=None):
+        """The given products that pass the same filters as search(), in input order."""
+        with self._lock:
+            rows = np.array([self._rows[p] for p in product_ids if p in self._rows], dtype=np.int64)
+            filters = dict(attributes or {})
+            filters['category'] = category
+            rows = rows[np.isin(rows, self._candidate_rows(filters))]
+            allowed = set(self._filter_rows(rows, min_price, max_price, in_stock).tolist())
+            return [p for p in product_ids if self._rows.get(p) in allowed]
+
+    def partition_sizes(self, name='category'):
+        """Number of products per value of a partition attribute."""
+        with self._lock:
+            if name not in self._codes:
+                return {}
+            partition = self._partition(name)
+            return {value: len(partition.get(code, ())) for value, code in self._vocab[name].items()}
+
+    def embedding(self, product_id):
+        """Stored (normalized) embedding of a product, or None."""
+        with self._lock:
+            row = self._rows.get(product_id)
+            return None if row is None else self._embeddings[row].copy()
+
+    def search(self, query, top_k=10, category=None, attributes=None,
+               min_price=None, max_price=None, in_stock=None, exclude=None):
+        """
+        Find the most similar products within the requested partition
+
+        Args:
+            query: Query feature vector
+            top_k: Number of results to return
+            category: Only search this category's partition
+            attributes: Optional {name: value} of extra partition filters
+            min_price / max_price: Price range (inclusive)
+            in_stock: If True, only in-stock products
+            exclude: Optional productId (or collection of productIds) to leave out
+
+        Returns:
+            List of (productId, similarity) sorted by similarity (descending)
+        """
+        with self._lock:
+            filters = dict(attributes or {})
+            filters['category'] = category
+            rows = self._filter_rows(self._candidate_rows(filters), min_price, max_price, in_stock)
+            if exclude is not None:
+                excluded = [exclude] if isinstance(exclude, str) else exclude
+                excluded_rows = [self._rows[product_id] for product_id in excluded if product_id in self._rows]
+                if excluded_rows:
+                    rows = rows[~np.isin(rows, excluded_rows)]
+
+            if len(rows) == 0 or top_k <= 0:
+                return []
+
+            query = np.asarray(query, dtype=np.float32).reshape(-1)
+            norm = np.linalg.norm(query)
+            if norm == 0:
+                return []
+
+            similarities = self._embeddings[rows] @ (query / norm)
+
+            if len(rows) > top_k:
+                top = np.argpartition(-similarities, top_k - 1)[:top_k]
+            else:
+                top = np.arange(len(rows))
+            top = top[np.argsort(-similarities[top], kind='stable')]
+
+            return [(self._ids[rows[i]], float(similarities[i])) for i in top]
@@ -12,6 +12,8 @@ import io
 import os
 import numpy as np
 from PIL import Image
+from image_hash import compute_hash, hash_to_hex
+from request_tracing import trace_stage
 
 # Suppress TensorFlow warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -42,48 +44,62 @@ def get_model():
         _model = MobileNetV2(weights='imagenet', include_top=False, pooling='avg')
     return _model
 
+def load_image_from_bytes(image_data):
+    """Load image from raw encoded bytes (JPEG/PNG/WebP...)."""
+    with trace_stage('pil_decode'):
+        img = Image.open(io.BytesIO(image_data))
+        img.load()  # Image.open is lazy - decode here so the time lands in this stage
+        
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+    
+    return img
+
 def load_image_from_base64(base64_string):
     """Load image from base64 string."""
-    if ',' in base64_string:
-        base64_string = base64_string.split(',')[1]
-    
-    image_data = base64.b64decode(base64_string)
-    img = Image.open(io.BytesIO(image_data))
-    
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+    with trace_stage('base64_decode'):
+        if ',' in base64_string:
+            base64_string = base64_string.split(',')[1]
+        image_data = base64.b64decode(base64_string)
     
-    return img
+    return load_image_from_bytes(image_data)
 
 def load_image_from_url(url):
     """Load image from URL."""
     import urllib.request
     
     try:
-        with urllib.request.urlopen(url, timeout=5) as response:
-            image_data = response.read()
-        img = Image.open(io.BytesIO(image_data))
+        with trace_stage('url_fetch'):
+            with urllib.request.urlopen(url, timeout=5) as response:
+                image_data = response.read()
         
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        return img
+        return load_image_from_bytes(image_data)
     except Exception as e:
         raise ValueError(f"Failed to load image from URL: {str(e)}")
 
+INPUT_SIZE = (224, 224)
+
+def resize_image(img):
+    """Resize image to the model input size as a uint8 (224, 224, 3) array."""
+    with trace_stage('resize'):
+        img = img.resize(INPUT_SIZE, Image.Resampling.LANCZOS)
+    return np.asarray(img, dtype=np.uint8)
+
 def preprocess_image(img):
     """Preprocess image for MobileNetV2."""
     # Resize to 224x224 (input size)
-    img = img.resize((224, 224), Image.Resampling.LANCZOS)
-    
-    # Convert to numpy array
-    img_array = keras_image.img_to_array(img)
+    with trace_stage('resize'):
+        img = img.resize(INPUT_SIZE, Image.Resampling.LANCZOS)
     
-    # Expand dimensions for batch
-    img_array = np.expand_dims(img_array, axis=0)
-    
-    # Apply preprocessing
-    img_array = preprocess_input(img_array)
+    with trace_stage('preprocess'):
+        # Convert to numpy array
+        img_array = keras_image.img_to_array(img)
+        
+        # Expand dimensions for batch
+        img_array = np.expand_dims(img_array, axis=0)
+        
+        # Apply preprocessing
+        img_array = preprocess_input(img_array)
     
     return img_array
 
@@ -91,9 +107,28 @@ def extract_features(img):
     """Extract feature vector from image using MobileNetV2."""
     model = get_model()
     preprocessed = preprocess_image(img)
-    features = model.predict(preprocessed, verbose=0)
+    with trace_stage('predict'):
+        features = model.predict(preprocessed, verbose=0)
     return features.flatten()
 
+def extract_features_batch(image_arrays, batch_size=32):
+    """
+    Extract feature vectors for a batch of resized images.
+    
+    Args:
+        image_arrays: uint8 array of shape (N, 224, 224, 3), e.g. from resize_image
+        batch_size: Inference batch size passed to the model
+    
+    Returns:
+        float32 array of shape (N, 1280)
+    """
+    model = get_model()
+    with trace_stage('preprocess'):
+        batch = preprocess_input(np.asarray(image_arrays, dtype=np.float32))
+    with trace_stage('predict'):
+        features = model.predict(batch, batch_size=batch_size, verbose=0)
+    return features.astype(np.float32, copy=False)
+
 def cosine_similarity(a, b):
     """Calculate cosine similarity between two vectors."""
     dot_product = np.dot(a, b)
@@ -207,6 +242,24 @@ def main():
                 "features": features.tolist()
             }))
             
+        elif action == 'hash':
+            image_base64 = data.get('image')
+            
+            if not image_base64:
+                print(json.dumps({
+                    "success": False,
+                    "error": "No image provided"
+                }))
+                sys.exit(1)
+            
+            img = load_image_from_base64(image_base64)
+            
+            print(json.dumps({
+                "success": True,
+                "phash": hash_to_hex(compute_hash(img, 'phash')),
+                "dhash": hash_to_hex(compute_hash(img, 'dhash'))
+            }))
+            
         elif action == 'health':
             _ = get_model()
             print(json.dumps({
@@ -2,6 +2,17 @@
 """
 Visual Search Server - Persistent HTTP server that keeps model in memory
 Uses Flask for simple HTTP API, model stays loaded = instant responses
+
+Transport for /extract is negotiated by content type:
+- Request: JSON {image: base64 | url}, multipart/form-data (field "image"),
+  or the raw encoded image as application/octet-stream / image/*
+- Response: JSON float list (default), application/x-npy (float32 .npy),
+  or application/octet-stream (raw little-endian float32)
+
+Every traced response carries a Server-Timing header with per-stage durations;
+/metrics aggregates them into histograms and /debug/profile exposes opt-in
+cProfile captures of recent requests (only when VISUAL_SEARCH_PROFILE_ENDPOINT=1,
+since the server listens on all interfaces).
 """
 
 import os
@@ -19,10 +30,16 @@ if sys.platform == 'win32':
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 import numpy as np
 from PIL import Image
+from image_hash import HashIndex, compute_hash, hash_to_hex, hex_to_hash
+from visual_index import VisualIndex
+from collaborative_filtering import CollaborativeFilteringModel
+from hybrid_ranking import HybridRanker
+from embedding_backfill import load_index_from_chunks
+from request_tracing import trace_stage, start_trace, end_trace, StageHistograms, SamplingProfiler
 
 print("🔄 Loading TensorFlow and MobileNetV2 model...", flush=True)
 
@@ -37,48 +54,167 @@ print("📥 Downloading and initializing MobileNetV2...", flush=True)
 MODEL = MobileNetV2(weights='imagenet', include_top=False, pooling='avg')
 print("✅ Model loaded and ready!", flush=True)
 
+# Perceptual hash index - near-duplicate lookups without running the CNN
+HASH_METHOD = os.environ.get('VISUAL_HASH_METHOD', 'phash')
+HASH_INDEX = HashIndex(max_distance=int(os.environ.get('VISUAL_HASH_MAX_DISTANCE', 6)))
+
+# Category-partitioned embedding index, populated through /index/products
+VISUAL_INDEX = VisualIndex(dim=MODEL.output_shape[-1])
+
+# Optionally warm the indexes from embedding_backfill.py output
+VISUAL_INDEX_DIR = os.environ.get('VISUAL_INDEX_DIR')
+if VISUAL_INDEX_DIR and os.path.isdir(VISUAL_INDEX_DIR):
+    loaded = load_index_from_chunks(VISUAL_INDEX_DIR, VISUAL_INDEX, HASH_INDEX)
+    print(f"📦 Loaded {loaded} embeddings from {VISUAL_INDEX_DIR}", flush=True)
+
+# Hybrid ranking: visual candidates re-ranked by the user's CF score
+CF_MODEL_PATH = os.environ.get('CF_MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cf_model.pkl'))
+RANKER = HybridRanker(
+    VISUAL_INDEX,
+    visual_weight=float(os.environ.get('HYBRID_VISUAL_WEIGHT', 0.7)),
+    cf_weight=float(os.environ.get('HYBRID_CF_WEIGHT', 0.3))
+)
+_cf_model_mtime = None
+
+# Per-stage latency histograms + opt-in sampling profiler (VISUAL_SEARCH_PROFILE=1)
+STAGE_HISTOGRAMS = StageHistograms()
+PROFILER = SamplingProfiler(
+    capacity=int(os.environ.get('VISUAL_SEARCH_PROFILE_CAPACITY', 20)),
+    sample_rate=float(os.environ.get('VISUAL_SEARCH_PROFILE_RATE', 1.0)),
+    enabled=os.environ.get('VISUAL_SEARCH_PROFILE') == '1'
+)
+# /debug/profile can switch profiling on for all traffic, so it is off unless asked for
+PROFILE_ENDPOINT_ENABLED = os.environ.get('VISUAL_SEARCH_PROFILE_ENDPOINT') == '1'
+UNTRACED_ENDPOINTS = {'health', 'metrics', 'debug_profile'}
+
 app = Flask(__name__)
-CORS(app)  # Allow cross-origin requests
+CORS(app, expose_headers=['Server-Timing'])  # Allow cross-origin requests
+
+@app.before_request
+def begin_request_trace():
+    """Start the stage trace (and maybe a profile) for this request."""
+    if request.endpoint is None or request.endpoint in UNTRACED_ENDPOINTS:
+        return
+    start_trace(request.endpoint)
+    g.profile = PROFILER.start()
+
+@app.after_request
+def finish_request_trace(response):
+    """Attach the Server-Timing header and feed the /metrics histograms."""
+    trace = end_trace()
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+        STAGE_HISTOGRAMS.record(trace)
+    return response
+
+@app.teardown_request
+def stop_request_profile(error=None):
+    """Runs even when a request fails, so the profiler is always released."""
+    PROFILER.stop(g.pop('profile', None), label=request.endpoint)
+
+# Embedding response formats, in order of preference when the client accepts anything
+NPY_MIMETYPE = 'application/x-npy'
+RAW_MIMETYPE = 'application/octet-stream'
+EMBEDDING_MIMETYPES = ['application/json', NPY_MIMETYPE, RAW_MIMETYPE]
+
+def load_image_from_bytes(image_data):
+    """Load image from raw encoded bytes (JPEG/PNG/WebP...)."""
+    with trace_stage('pil_decode'):
+        img = Image.open(io.BytesIO(image_data))
+        img.load()  # Image.open is lazy - decode here so the time lands in this stage
+        
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+    
+    return img
 
 def load_image_from_base64(base64_string):
     """Load image from base64 string."""
-    if ',' in base64_string:
-        base64_string = base64_string.split(',')[1]
+    with trace_stage('base64_decode'):
+        if ',' in base64_string:
+            base64_string = base64_string.split(',')[1]
+        image_data = base64.b64decode(base64_string)
     
-    image_data = base64.b64decode(base64_string)
-    img = Image.open(io.BytesIO(image_data))
-    
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    return img
+    return load_image_from_bytes(image_data)
 
 def load_image_from_url(url):
     """Load image from URL."""
     import urllib.request
     
-    with urllib.request.urlopen(url, timeout=5) as response:
-        image_data = response.read()
-    img = Image.open(io.BytesIO(image_data))
+    with trace_stage('url_fetch'):
+        with urllib.request.urlopen(url, timeout=5) as response:
+            image_data = response.read()
     
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+    return load_image_from_bytes(image_data)
+
+def load_image_source(image_data):
+    """Load image from a base64 string / data URL or an http(s) URL."""
+    if image_data.startswith('data:') or len(image_data) > 500:
+        return load_image_from_base64(image_data)
+    return load_image_from_url(image_data)
+
+def load_request_image():
+    """
+    Load the query image from the current request, whatever its transport.
+    Returns None if the request carries no image.
+    """
+    if request.mimetype == 'multipart/form-data':
+        with trace_stage('read_body'):
+            upload = request.files.get('image')
+            image_data = upload.read() if upload else None
+        return load_image_from_bytes(image_data) if image_data else None
     
-    return img
+    if request.mimetype == RAW_MIMETYPE or request.mimetype.startswith('image/'):
+        with trace_stage('read_body'):
+            image_data = request.get_data(cache=False)
+        return load_image_from_bytes(image_data) if image_data else None
+    
+    with trace_stage('read_body'):
+        data = request.get_json(silent=True) or {}
+    image_data = data.get('image') or data.get('imageUrl')
+    if not image_data:
+        return None
+    
+    return load_image_source(image_data)
+
+def embedding_response(features):
+    """Serialize a float32 feature vector in the format the client accepts."""
+    mimetype = request.accept_mimetypes.best_match(EMBEDDING_MIMETYPES, default='application/json')
+    
+    with trace_stage('serialize'):
+        if mimetype == NPY_MIMETYPE:
+            buffer = io.BytesIO()
+            np.save(buffer, features.astype('<f4', copy=False))
+            body = buffer.getvalue()
+        elif mimetype == RAW_MIMETYPE:
+            body = features.astype('<f4', copy=False).tobytes()
+        else:
+            return jsonify({
+                'success': True,
+                'features': features.tolist()
+            })
+    
+    response = Response(body, mimetype=mimetype)
+    response.headers['X-Embedding-Dim'] = str(features.shape[0])
+    response.headers['X-Embedding-Dtype'] = 'float32-le'
+    return response
 
 def extract_features(img):
     """Extract feature vector from image using MobileNetV2."""
     # Resize to 224x224
-    img = img.resize((224, 224), Image.Resampling.LANCZOS)
+    with trace_stage('resize'):
+        img = img.resize((224, 224), Image.Resampling.LANCZOS)
     
     # Convert to array
-    img_array = keras_image.img_to_array(img)
-    img_array = np.expand_dims(img_array, axis=0)
-    img_array = preprocess_input(img_array)
+    with trace_stage('preprocess'):
+        img_array = keras_image.img_to_array(img)
+        img_array = np.expand_dims(img_array, axis=0)
+        img_array = preprocess_input(img_array)
     
     # Extract features (model is already loaded!)
-    features = MODEL.predict(img_array, verbose=0)
-    return features.flatten().tolist()
+    with trace_stage('predict'):
+        features = MODEL.predict(img_array, verbose=0)
+    return features.flatten().astype(np.float32, copy=False)
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -94,29 +230,361 @@ def health():
 def extract():
     """Extract features from an image."""
     try:
-        data = request.get_json()
-        image_data = data.get('image') or data.get('imageUrl')
+        img = load_request_image()
         
-        if not image_data:
+        if img is None:
             return jsonify({'success': False, 'error': 'No image provided'}), 400
         
-        # Load image
-        if image_data.startswith('data:') or len(image_data) > 500:
-            img = load_image_from_base64(image_data)
-        else:
-            img = load_image_from_url(image_data)
-        
         # Extract features (instant since model is loaded!)
         features = extract_features(img)
         
+        return embedding_response(features)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/hash', methods=['POST'])
+def image_hashes():
+    """Compute perceptual hashes (hex) for an image."""
+    try:
+        img = load_request_image()
+        
+        if img is None:
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+        
+        with trace_stage('hash'):
+            hashes = {
+                'phash': hash_to_hex(compute_hash(img, 'phash')),
+                'dhash': hash_to_hex(compute_hash(img, 'dhash'))
+            }
+        
+        return jsonify({'success': True, **hashes})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/index/hashes', methods=['POST'])
+def index_hashes():
+    """
+    Bulk-register product hashes.
+    Body: {items: [{productId, hash?, image?}]} - image is hashed when no hash is given
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        indexed = 0
+        failed = []
+        
+        for item in data.get('items', []):
+            product_id = item.get('productId')
+            try:
+                if item.get('hash'):
+                    value = hex_to_hash(item['hash'])
+                else:
+                    value = compute_hash(load_image_source(item.get('image') or item.get('imageUrl')), HASH_METHOD)
+                HASH_INDEX.add(product_id, value)
+                indexed += 1
+            except Exception:
+                failed.append(product_id)
+        
+        return jsonify({
+            'success': True,
+            'indexed': indexed,
+            'failed': failed,
+            'total': len(HASH_INDEX)
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/duplicates', methods=['POST'])
+def duplicates():
+    """Find exact / near-duplicate products of an image by Hamming distance (no CNN)."""
+    try:
+        img = load_request_image()
+        
+        if img is None:
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+        
+        with trace_stage('hash'):
+            value = compute_hash(img, HASH_METHOD)
+        max_distance = request.args.get('maxDistance', type=int)
+        with trace_stage('hash_lookup'):
+            matches = HASH_INDEX.lookup(value, max_distance)
+        
         return jsonify({
             'success': True,
-            'features': features
+            'hash': hash_to_hex(value),
+            'matches': [
+                {'productId': product_id, 'distance': distance}
+                for product_id, distance in matches
+            ]
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def refresh_cf_model():
+    """(Re)load the CF model whenever cf_model.pkl changes - cfRecommender.js retrains it."""
+    global _cf_model_mtime
+    try:
+        mtime = os.path.getmtime(CF_MODEL_PATH)
+    except OSError:
+        return RANKER.cf_model
+    
+    if mtime != _cf_model_mtime:
+        model = CollaborativeFilteringModel()
+        model.load_model(CF_MODEL_PATH)
+        RANKER.cf_model = model
+        _cf_model_mtime = mtime
+    return RANKER.cf_model
+
+class InvalidParameter(ValueError):
+    """A request option with an unusable value (reported as 400, not 500)."""
+
+def search_params():
+    """Search options from the JSON body, falling back to the query string (binary uploads)."""
+    data = request.get_json(silent=True) or {}
+    
+    def param(name, cast):
+        value = data.get(name, request.args.get(name))
+        return None if value is None or value == '' else cast(value)
+    
+    def as_bool(value):
+        return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+    
+    try:
+        top_k = param('topN', int)
+    except (TypeError, ValueError):
+        raise InvalidParameter('topN must be a positive integer')
+    if top_k is not None and top_k < 1:
+        raise InvalidParameter('topN must be a positive integer')
+    
+    return {
+        'top_k': 10 if top_k is None else top_k,
+        'category': param('category', str),
+        'attributes': data.get('attributes'),
+        'min_price': param('minPrice', float),
+        'max_price': param('maxPrice', float),
+        'in_stock': param('inStock', as_bool)
+    }
+
+@app.route('/index/products', methods=['POST'])
+def index_products():
+    """
+    Bulk-upsert products into the visual index.
+    Body: {items: [{productId, embedding, category?, price?, inStock?, attributes?, hash?}],
+           remove: [productId]}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        indexed = 0
+        failed = []
+        
+        for item in data.get('items', []):
+            product_id = item.get('productId')
+            try:
+                VISUAL_INDEX.upsert(
+                    product_id,
+                    item['embedding'],
+                    category=item.get('category'),
+                    price=item.get('price'),
+                    in_stock=item.get('inStock', True),
+                    attributes=item.get('attributes')
+                )
+                if item.get('hash'):
+                    HASH_INDEX.add(product_id, hex_to_hash(item['hash']))
+                indexed += 1
+            except Exception:
+                failed.append(product_id)
+        
+        for product_id in data.get('remove', []):
+            VISUAL_INDEX.remove(product_id)
+            HASH_INDEX.remove(product_id)
+        
+        return jsonify({
+            'success': True,
+            'indexed': indexed,
+            'failed': failed,
+            'total': len(VISUAL_INDEX),
+            'categories': VISUAL_INDEX.partition_sizes('category')
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/search', methods=['POST'])
+def search():
+    """
+    Visual search against the in-memory index.
+    Near-duplicates found in the hash index come first (with their Hamming
+    distance); the rest of the top-N is ranked by embedding similarity, using
+    the best duplicate's stored embedding as the query so the CNN is skipped.
+    Only the requested category partition is ranked, with price/stock filters
+    applied before top-K.
+    """
+    try:
+        img = load_request_image()
+        
+        if img is None:
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+        
+        params = search_params()
+        top_k = params['top_k']
+        filters = {name: value for name, value in params.items() if name != 'top_k'}
+        
+        with trace_stage('hash'):
+            value = compute_hash(img, HASH_METHOD)
+        with trace_stage('hash_lookup'):
+            distances = dict(HASH_INDEX.lookup(value))
+            # Scope duplicates with the same filters as a normal search
+            duplicates = VISUAL_INDEX.matching(list(distances), **filters)[:top_k]
+            # A concurrent /index/products call may remove a duplicate in between
+            embeddings = {product_id: VISUAL_INDEX.embedding(product_id) for product_id in duplicates}
+            duplicates = [product_id for product_id in duplicates if embeddings[product_id] is not None]
+        
+        if duplicates:
+            source = 'hash'
+            query = embeddings[duplicates[0]]
+        else:
+            source = 'embeddings'
+            query = extract_features(img)
+        
+        with trace_stage('index_search'):
+            norm = np.linalg.norm(query)
+            results = [
+                {
+                    'productId': product_id,
+                    'similarity': float(embeddings[product_id] @ query / norm) if norm else 0.0,
+                    'matchType': 'duplicate',
+                    'hammingDistance': distances[product_id]
+                }
+                for product_id in duplicates
+            ]
+            matches = VISUAL_INDEX.search(query, top_k=top_k - len(duplicates), exclude=duplicates, **filters)
+            results += [
+                {'productId': product_id, 'similarity': similarity}
+                for product_id, similarity in matches
+            ]
+        
+        return jsonify({'success': True, 'source': source, 'results': results})
+        
+    except InvalidParameter as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/hybrid', methods=['POST'])
+def hybrid():
+    """
+    Personalized visual search: visual candidates re-ranked by CF user affinity.
+    Query is either an image (any /extract transport) or an indexed productId.
+    Options: userId, visualWeight, cfWeight, plus the /search filters.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = data.get('userId', request.args.get('userId'))
+        product_id = data.get('productId', request.args.get('productId'))
+
+        weights = {}
+        for name in ('visualWeight', 'cfWeight'):
+            value = data.get(name, request.args.get(name))
+            if value is None or value == '':
+                weights[name] = None
+                continue
+            try:
+                weights[name] = float(value)
+            except (TypeError, ValueError):
+                weights[name] = float('nan')
+            if not np.isfinite(weights[name]) or weights[name] < 0:
+                return jsonify({'success': False, 'error': f'{name} must be a non-negative number'}), 400
+        visual_weight, cf_weight = weights['visualWeight'], weights['cfWeight']
+        if visual_weight == 0 and cf_weight == 0:
+            return jsonify({'success': False, 'error': 'visualWeight and cfWeight cannot both be 0'}), 400
+        params = search_params()
+
+        if product_id:
+            query = VISUAL_INDEX.embedding(product_id)
+            if query is None:
+                return jsonify({'success': False, 'error': f'Product {product_id} is not indexed'}), 404
+        else:
+            img = load_request_image()
+            if img is None:
+                return jsonify({'success': False, 'error': 'No image or productId provided'}), 400
+            query = extract_features(img)
+        
+        with trace_stage('cf_load'):
+            cf_model = refresh_cf_model()
+        with trace_stage('rank'):
+            results = RANKER.rank(
+                query,
+                user_id=user_id,
+                visual_weight=visual_weight,
+                cf_weight=cf_weight,
+                exclude=product_id,
+                **params
+            )
+        
+        return jsonify({
+            'success': True,
+            'userId': user_id,
+            # Only true when the CF model actually scored some of the returned products
+            'personalized': any(result['predictedRating'] is not None for result in results),
+            'results': results
+        })
+        
+    except InvalidParameter as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Per-stage latency histograms (Prometheus text; ?format=json for JSON)."""
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'stages': STAGE_HISTOGRAMS.to_json()})
+    return Response(STAGE_HISTOGRAMS.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """
+    Sampling profiler control and dump.
+    POST ?enabled=1&sampleRate=0.1&capacity=50&clear=1 - configure
+    GET  ?sort=cumulative&limit=60                     - merged pstats text of the last N captures
+    GET  ?format=prof                                  - merged capture as .prof (snakeviz / flameprof)
+    Returns 404 unless VISUAL_SEARCH_PROFILE_ENDPOINT=1.
+    """
+    if not PROFILE_ENDPOINT_ENABLED:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    
+    if request.method == 'POST':
+        enabled = request.args.get('enabled')
+        PROFILER.configure(
+            enabled=None if enabled is None else enabled in ('1', 'true'),
+            sample_rate=request.args.get('sampleRate', type=float),
+            capacity=request.args.get('capacity', type=int)
+        )
+        if request.args.get('clear') in ('1', 'true'):
+            PROFILER.clear()
+        return jsonify({
+            'success': True,
+            'enabled': PROFILER.enabled,
+            'sampleRate': PROFILER.sample_rate,
+            'captures': len(PROFILER)
+        })
+    
+    if request.args.get('format') == 'prof':
+        data = PROFILER.dump_binary()
+        if data is None:
+            return jsonify({'success': False, 'error': 'No profiles captured'}), 404
+        return Response(data, mimetype='application/octet-stream', headers={
+            'Content-Disposition': 'attachment; filename=visual_search.prof'
+        })
+    
+    return Response(
+        PROFILER.dump_text(request.args.get('sort', 'cumulative'), request.args.get('limit', 60, type=int)),
+        mimetype='text/plain'
+    )
+
 if __name__ == '__main__':
     port = int(os.environ.get('VISUAL_SEARCH_PORT', 5001))
     print(f"🚀 Visual Search Server running on http://localhost:{port}", flush=True)
@@ -0,0 +1,58 @@
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { spawnSync } = require('child_process');
+
+const PYTHON_PATH = process.env.PYTHON_PATH || 'python';
+const CF_INTEGRATION_SCRIPT = path.join(__dirname, '../../ai_models/cf_integration.py');
+
+describe('INTEGRATION: CF Product Attributes Survive Retraining', () => {
+
+  let modelDir;
+
+  // Run cf_integration.py against a throwaway model file
+  const runCF = (args, input) => {
+    const result = spawnSync(PYTHON_PATH, [CF_INTEGRATION_SCRIPT, ...args], {
+      input: input ? JSON.stringify(input) : undefined,
+      env: { ...process.env, CF_MODEL_PATH: path.join(modelDir, 'cf_model.pkl') },
+      encoding: 'utf-8'
+    });
+    return JSON.parse(result.stdout);
+  };
+
+  // 10 users, 20 products, 3 ratings per product
+  const interactions = [];
+  for (let p = 0; p < 20; p++) {
+    for (let k = 0; k < 3; k++) {
+      interactions.push({ userId: `u${(p * 3 + k) % 10}`, productId: `p${p}`, rating: ((p + k) % 5) + 1 });
+    }
+  }
+
+  beforeEach(() => {
+    modelDir = fs.mkdtempSync(path.join(os.tmpdir(), 'cf-model-'));
+  });
+
+  afterEach(() => {
+    fs.rmSync(modelDir, { recursive: true, force: true });
+  });
+
+  // ✅ Test 1: Out-of-stock flags are kept by a retrain
+  test('Should keep in_stock filter after retraining', () => {
+    expect(runCF(['train'], { interactions }).success).toBe(true);
+
+    const outOfStock = Array.from({ length: 14 }, (_, i) => `p${i}`);
+    const update = runCF(['update-attributes'], {
+      products: outOfStock.map(productId => ({ productId, inStock: false }))
+    });
+    expect(update.success).toBe(true);
+    expect(update.updated).toBe(14);
+
+    expect(runCF(['train'], { interactions }).success).toBe(true);
+
+    const res = runCF(['recommend', 'u1', '20', JSON.stringify({ in_stock: true })]);
+    expect(res.success).toBe(true);
+    res.recommendations.forEach(rec => {
+      expect(outOfStock).not.toContain(rec.product_id);
+    });
+  });
+});
@@ -0,0 +1,69 @@
+const path = require('path');
+const { spawnSync } = require('child_process');
+
+const PYTHON_PATH = process.env.PYTHON_PATH || 'python';
+const AI_MODELS_DIR = path.join(__dirname, '../../ai_models');
+
+// Trains a CF model on two groups of users with opposite tastes, indexes 20 products that
+// are all about equally similar to the query, and prints each user's hybrid ordering
+const RANK_SCRIPT = `
+import io, json, sys
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from collaborative_filtering import CollaborativeFilteringModel
+from hybrid_ranking import HybridRanker
+from visual_index import VisualIndex
+
+rng = np.random.default_rng(0)
+rows = []
+for u in range(20):
+    liked = range(0, 10) if u % 2 == 0 else range(10, 20)
+    for p in rng.choice(20, size=12, replace=False):
+        rows.append({'user_id': f'u{u}', 'product_id': f'p{p}', 'rating': 5 if p in liked else 1})
+
+model = CollaborativeFilteringModel(n_factors=4)
+with redirect_stdout(io.StringIO()):
+    model.train(pd.DataFrame(rows))
+
+query = np.ones(8, dtype=np.float32)
+index = VisualIndex(dim=8)
+for p in range(20):
+    index.upsert(f'p{p}', query + rng.normal(scale=0.01, size=8))
+
+ranker = HybridRanker(index, model, visual_weight=0.5, cf_weight=0.5)
+print(json.dumps({
+    user_id: [r['productId'] for r in ranker.rank(query, user_id=user_id, top_k=5)]
+    for user_id in sys.argv[1:]
+}))
+`;
+
+describe('INTEGRATION: Hybrid Ranking Personalization', () => {
+
+  const rank = (...userIds) => {
+    const result = spawnSync(PYTHON_PATH, ['-c', RANK_SCRIPT, ...userIds], {
+      cwd: AI_MODELS_DIR,
+      encoding: 'utf-8'
+    });
+    return JSON.parse(result.stdout);
+  };
+
+  const productNumber = productId => parseInt(productId.slice(1), 10);
+
+  // ✅ Test 1: Users with different tastes get different orderings for the same image
+  test('Should order visually similar products by each user\'s CF affinity', () => {
+    const orderings = rank('u0', 'u1');
+
+    expect(orderings.u0).toHaveLength(5);
+    expect(orderings.u1).toHaveLength(5);
+    expect(orderings.u0).not.toEqual(orderings.u1);
+    orderings.u0.forEach(productId => expect(productNumber(productId)).toBeLessThan(10));
+    orderings.u1.forEach(productId => expect(productNumber(productId)).toBeGreaterThanOrEqual(10));
+  });
+
+  // ✅ Test 2: Unknown users keep the visual order
+  test('Should give unknown users the same ordering', () => {
+    const orderings = rank('stranger1', 'stranger2');
+    expect(orderings.stranger1).toEqual(orderings.stranger2);
+  });
+});
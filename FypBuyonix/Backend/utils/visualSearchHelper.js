@@ -135,6 +135,68 @@ class VisualSearchHelper {
         });
     }
 
+    /**
+     * POST raw bytes to the server and read back a binary float32 embedding.
+     * Avoids base64 inflation on the way in and JSON float lists on the way out.
+     */
+    async httpRequestBinary(endpoint, body, contentType = 'application/octet-stream') {
+        const url = new URL(`${this.serverUrl}${endpoint}`);
+
+        return new Promise((resolve, reject) => {
+            const http = require('http');
+
+            const req = http.request({
+                hostname: url.hostname,
+                port: url.port,
+                path: url.pathname,
+                method: 'POST',
+                headers: {
+                    'Content-Type': contentType,
+                    'Content-Length': body.length,
+                    'Accept': 'application/octet-stream'
+                }
+            }, (res) => {
+                const chunks = [];
+                res.on('data', chunk => chunks.push(chunk));
+                res.on('end', () => {
+                    const payload = Buffer.concat(chunks);
+                    const responseType = res.headers['content-type'] || '';
+
+                    // Errors are always reported as JSON
+                    if (responseType.startsWith('application/json')) {
+                        try {
+                            const result = JSON.parse(payload.toString());
+                            return reject(new Error(result.error || 'Feature extraction failed'));
+                        } catch (e) {
+                            return reject(new Error(`Invalid JSON response: ${payload}`));
+                        }
+                    }
+
+                    // Anything else must be a complete float32 vector (not e.g. a proxy's HTML error page)
+                    if (res.statusCode !== 200) {
+                        return reject(new Error(`Feature extraction failed: HTTP ${res.statusCode}`));
+                    }
+                    const expectedDim = parseInt(res.headers['x-embedding-dim'], 10);
+                    if (payload.length === 0 || payload.length % 4 !== 0 ||
+                        (!Number.isNaN(expectedDim) && payload.length !== expectedDim * 4)) {
+                        return reject(new Error(`Invalid embedding response (${payload.length} bytes, ${responseType || 'no content type'})`));
+                    }
+
+                    const features = new Array(payload.length / 4);
+                    for (let i = 0; i < features.length; i++) {
+                        features[i] = payload.readFloatLE(i * 4);
+                    }
+                    resolve(features);
+                });
+            });
+
+            req.on('error', reject);
+            req.setTimeout(120000, () => reject(new Error('Request timeout')));
+            req.write(body);
+            req.end();
+        });
+    }
+
     sleep(ms) {
         return new Promise(resolve => setTimeout(resolve, ms));
     }
@@ -162,6 +224,12 @@ class VisualSearchHelper {
     async extractFeatures(imageData) {
         await this.ensureServerRunning();
 
+        // Inline images go over the wire as raw bytes, URLs are fetched by the server
+        if (typeof imageData === 'string' && (imageData.startsWith('data:') || imageData.length > 500)) {
+            const base64 = imageData.includes(',') ? imageData.split(',')[1] : imageData;
+            return this.httpRequestBinary('/extract', Buffer.from(base64, 'base64'));
+        }
+
         const result = await this.httpRequest('/extract', 'POST', {
             image: imageData
         });